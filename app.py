@@ -1,4 +1,5 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import numpy as np
 import io
@@ -11,6 +12,15 @@ from docx.oxml.shared import OxmlElement
 from docx.oxml.ns import qn
 import docx.opc.constants
 import time
+import warnings
+import os
+import zipfile
+import contextlib
+import html
+import hashlib
+import re
+import threading
+from collections import OrderedDict
 
 # ==========================================
 # PART 1: 配置区域 (修复了字段映射)
@@ -29,6 +39,9 @@ COMMON_METRICS = {
     "aov": ["单次购买价值", "单次购物价值"]
 }
 
+# 维度 Sheet 的按天拆分列：有则异常检测按「对象 × 日期」打分，报告表格再按对象汇总
+BREAKDOWN_DATE = {"date_range": ["时间范围", "天", "Day"]}
+
 # 框定「每一个 Sheet」需要抽取哪些指标
 SHEET_MAPPINGS = {
     "整体数据": {
@@ -58,9 +71,10 @@ SHEET_MAPPINGS = {
         "anomaly_metric_name": ["异常指标"],
         "mom_change": ["环比"]
     },
-    "广告架构": {**COMMON_METRICS, "dimension_item": ["广告类型"]},
+    "广告架构": {**COMMON_METRICS, **BREAKDOWN_DATE, "dimension_item": ["广告类型"]},
     "受众组": {
         **COMMON_METRICS,
+        **BREAKDOWN_DATE,
         "dimension_item": ["广告组", "广告组Id", "Ad Set Name"],
         "custom_audience_settings": ["设置的自定义受众", "Custom Audiences"],
         "converting_keywords": ["产生成效的关键词", "Interests", "Keywords"],
@@ -68,24 +82,73 @@ SHEET_MAPPINGS = {
         "converting_genders": ["产生成效的性别", "性别", "Gender"],
         "converting_ages": ["产生成效的年龄", "年龄", "Age", "Age Group"]
     },
-    "受众类型": {**COMMON_METRICS, "dimension_item": ["受众类型"]},
-    "国家": {**COMMON_METRICS, "dimension_item": ["国家/地区", "国家"]},
-    "年龄": {**COMMON_METRICS, "dimension_item": ["年龄"]},
-    "性别": {**COMMON_METRICS, "dimension_item": ["性别"]},
-    "平台&版位": {**COMMON_METRICS, "dimension_item": ["平台&版位"]},
+    "受众类型": {**COMMON_METRICS, **BREAKDOWN_DATE, "dimension_item": ["受众类型"]},
+    "国家": {**COMMON_METRICS, **BREAKDOWN_DATE, "dimension_item": ["国家/地区", "国家"]},
+    "年龄": {**COMMON_METRICS, **BREAKDOWN_DATE, "dimension_item": ["年龄"]},
+    "性别": {**COMMON_METRICS, **BREAKDOWN_DATE, "dimension_item": ["性别"]},
+    "平台&版位": {**COMMON_METRICS, **BREAKDOWN_DATE, "dimension_item": ["平台&版位"]},
     "素材": {
         **COMMON_METRICS,
+        **BREAKDOWN_DATE,
         "content_item": ["素材"],
         "cvr_lp_to_pur": ["落地页浏览-购买转化率"]
     },
     "落地页": {
         **COMMON_METRICS,
+        **BREAKDOWN_DATE,
         "content_item": ["落地页url", "落地页"],
         "ctr_all": ["曝光-点击转化率"],
         "rate_lp_to_atc": ["落地页浏览-加购转化率", "落地页浏览-购物转化率"]
     }
 }
 
+# 纯文本列：ETL 时不做数值清洗
+TEXT_COLS = ['date_range', 'anomaly_metric_name',
+             'converting_keywords', 'converting_countries', 'converting_genders', 'converting_ages',
+             'custom_audience_settings', 'dimension_item', 'content_item']
+# calc_metrics_dict 需要的可加总指标
+ADDITIVE_METRICS = ['spend', 'clicks', 'impressions', 'purchases', 'purchase_value',
+                    'landing_page_views', 'add_to_cart', 'initiate_checkout']
+# 只保留花费 Top N 行的 Sheet
+TOPN_SHEETS = ["素材", "落地页", "受众组"]
+TOPN_LIMIT = 10
+
+# 截断后的长尾汇总成一行「其他 (共 N 项)」，N 为被汇总的对象数
+ROLLUP_LABEL = "其他"
+ROLLUP_PATTERN = rf"{ROLLUP_LABEL} \(共 (\d+) 项\)"
+# 多行合并 (「其他」汇总行、流式聚合) 时的比率指标：指标 -> (分子列, 分母列, 倍数)，由合并后的可加总列重算；
+# 不在此列或缺少分子/分母列的比率按花费加权平均
+ROLLUP_RATIOS = {
+    "roas": ("purchase_value", "spend", 1),
+    "cpa": ("spend", "purchases", 1),
+    "ctr": ("clicks", "impressions", 1),
+    "cpm": ("spend", "impressions", 1000),
+    "cpc": ("spend", "clicks", 1),
+    "aov": ("purchase_value", "purchases", 1),
+}
+# 排名配置：每个分区 (一张表) 的所有排名由 compute_rankings 一次算完
+#   metric / n / ascending：按哪个指标取前 n；where(col)：筛选条件，col(列名) 返回该列数值数组
+#   fallback：筛选后为空时退回不筛选；rollup：未入选的行汇总成「其他」行 (只剩一个对象时原样保留)；share：附加花费占比列 spend_share
+RANKING_CONFIG = {
+    "etl": {"top": {"metric": "spend", "n": TOPN_LIMIT, "rollup": True}},
+    "audience": {"top": {"metric": "spend", "n": 10, "rollup": True}},
+    "content": {"top": {"metric": "spend", "n": 10, "rollup": True}},
+    "placement": {
+        "top_spend": {"metric": "spend", "n": 5, "rollup": True},
+        "high_potential": {"metric": "ctr", "n": 5, "fallback": True,
+                           "where": lambda col: (col('ctr') > np.nanmean(col('ctr'))) & (col('cpm') < np.nanmean(col('cpm')))},
+    },
+    "structure": {"top1": {"metric": "spend", "n": 1, "share": True}},
+}
+
+# CSV / zip 流式读取：文件名 (去扩展名) 包含 Sheet 名即归入该 Sheet，如「素材.csv」「0101_素材.csv」
+CSV_CONFIG = {
+    "extensions": ('.csv', '.tsv', '.zip'),
+    "chunk_rows": 200_000,
+    "encodings": ["utf-8-sig", "gb18030"],
+    "group_keys": ["date_range", "dimension_item", "content_item"],
+}
+
 GROUP_CONFIG = {
     "Master_Overview": ["整体数据", "分时段数据", "异常指标"],
     "Master_Breakdown": ["广告架构", "受众组", "受众类型", "国家", "年龄", "性别", "平台&版位"],
@@ -127,6 +190,71 @@ FIELD_ALIASES = {
     "landing_page_views": ["landing_page_views", "落地页浏览量", "落地页", "landing"]
 }
 
+# 行业 Benchmark：{指标: [基准值, 是否越高越好]}，库里找不到时兜底
+DEFAULT_BENCHMARK_TARGETS = {'roas': [2.0, True], 'cpm': [20.0, False], 'ctr': [0.015, True], 'cpc': [1.5, False], 'cpa': [30.0, False]}
+# Benchmark 库目录：文件名约定为「行业_国家.xlsx / .csv」；表内若有 行业/国家 列则按行拆分
+BENCHMARK_DIR = os.environ.get("AD_BENCHMARK_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+BENCHMARK_ALL = "ALL"
+
+# 内存预算模式：单任务内存上限 (MB)，0 / 未设置表示不限制
+MEMORY_LIMIT_MB = float(os.environ.get("AD_MEMORY_LIMIT_MB", "0") or 0)
+MEMORY_CONFIG = {
+    # 分配密集的阶段开始前按「格数 × 每格字节」预估新增内存 (按实测取整并留余量)
+    "xlsx_bytes_per_cell": 320,     # openpyxl 解析 Sheet，实测约 270 B/格
+    "csv_bytes_per_cell": 64,       # 按字符串读入的 CSV 块
+    "csv_bytes_per_text_byte": 8,   # 第一块读入前按 CSV 文本大小预估
+    "export_bytes_per_cell": 480,   # xlsxwriter 导出时在内存里保留全部单元格，实测约 420 B/格
+    "docx_bytes_per_cell": 3072,    # python-docx 表格单元格的 XML 节点，实测约 2.7 KB/格
+    "count_cols": ["purchases", "clicks", "clicks_all", "impressions", "landing_page_views", "add_to_cart", "initiate_checkout"],
+    "category_cols": ["Source_Sheet", "dimension_item", "content_item"],
+    "category_max_ratio": 0.5,  # 去重后占比低于该值才转为 category
+}
+
+# final_json 各章节在 HTML 预览中的标题
+REPORT_SECTION_TITLES = {
+    "1_data_overview": "1. 数据大盘总览", "2_industry_benchmark": "2. 行业 Benchmark 对比",
+    "3_audience_analysis": "3. 受众组分析", "4_creative_analysis": "4. 素材分析",
+    "5_placement_analysis": "5. 版位分析", "6_landing_page_analysis": "6. 落地页分析",
+    "7_structure_analysis": "7. 广告架构分析", "8_anomaly_detection": "8. 异常检测",
+    "top_spend": "5.1 版位花费 TOP 5", "high_potential": "5.2 版位高潜力",
+    "total_flagged": "异常总数", "flagged_items": "异常对象数", "items": "异常明细", "periods": "对比周期",
+}
+
+# 多期对比：(展示名, 来源 Sheet, 对齐键)
+COMPARE_SECTIONS = [
+    ("国家", "国家", "dimension_item"),
+    ("年龄", "年龄", "dimension_item"),
+    ("版位", "平台&版位", "dimension_item"),
+    ("素材", "素材", "content_item"),
+    ("落地页", "落地页", "content_item"),
+]
+COMPARE_METRICS = ["spend", "roas", "cpa", "ctr"]
+COMPARE_CONFIG = {"max_rows": 50, "cache_entries": 16}
+
+# 排名显著性：95% 置信区间 (Wilson / Poisson)，与账户均值比较
+SIGNIFICANCE_CONFIG = {"z": 1.96, "level": "95%"}
+
+# 内置异常检测：指标 -> (分子列, 分母列, 是否越高越好)；比率指标由累加后的分子/分母重算
+ANOMALY_METRICS = {
+    "spend": ("spend", None, None),
+    "cpa": ("spend", "purchases", False),
+    "roas": ("purchase_value", "spend", True),
+    "ctr": ("clicks", "impressions", True),
+}
+ANOMALY_CONFIG = {
+    "sheets": ["分时段数据", "广告架构", "受众组", "受众类型", "国家", "年龄", "性别", "平台&版位", "素材", "落地页"],
+    "window": 7,            # 滚动窗口天数 (不含当天)
+    "min_periods": 3,       # 窗口内至少几天有数据才打分
+    "z_threshold": 3.0,     # 时间维度 rolling z-score 阈值
+    "mad_threshold": 3.5,   # 横截面 robust z (MAD) 阈值
+    "min_items": 5,         # 横截面检测至少需要的对象数
+    # 比率指标的量级下限：格子里的 (列) 累计值低于下限时比率波动太大，不参与打分
+    "min_volume": {"cpa": ("purchases", 5), "roas": ("purchases", 5), "ctr": ("impressions", 1000)},
+    "max_per_item": 3,      # 每个对象最多输出几天 (同一天的多个指标 / 方法合并为一条)
+    "max_json_rows": 200,
+    "max_report_rows": 20,
+}
+
 
 # ==========================================
 # PART 2: 核心工具函数 (已修复百分比识别问题)
@@ -173,6 +301,28 @@ def clean_numeric_strict(val):
     try: return float(val_str)
     except: return 0.0
 
+def clean_numeric_series(s):
+    """clean_numeric_strict 的向量化版本，供大文件分块清洗使用"""
+    if pd.api.types.is_numeric_dtype(s): return s.astype(float).fillna(0.0)
+    txt = s.astype(str).str.strip().str.replace(r'[$¥,]', '', regex=True)
+    is_pct = txt.str.contains('%', regex=False)
+    num = pd.to_numeric(txt.str.replace('%', '', regex=False), errors='coerce')
+    return num.where(~is_pct, num / 100.0).fillna(0.0)
+
+def match_sheet_columns(columns, mapping):
+    """按 SHEET_MAPPINGS 把原始列名对应到标准列名：{标准列: 原始列}"""
+    final_cols = {}
+    for std_col, raw_col_options in mapping.items():
+        matched_col = None
+        for option in raw_col_options:
+            if option in columns: matched_col = option; break
+            if not matched_col:
+                for df_col in columns:
+                    if option.replace(" ", "") == str(df_col).replace(" ", ""): matched_col = df_col; break
+            if matched_col: break
+        if matched_col: final_cols[std_col] = matched_col
+    return final_cols
+
 def find_column_fuzzy(df, keywords):
     for kw in keywords:
         if kw in df.columns: return kw
@@ -190,10 +340,7 @@ def calc_metrics_dict(df_chunk):
     res = {}
     if df_chunk.empty: return res
     sums = {}
-    targets = ['spend', 'clicks', 'impressions', 'purchases', 'purchase_value',
-               'landing_page_views', 'add_to_cart', 'initiate_checkout']
-    
-    for t in targets:
+    for t in ADDITIVE_METRICS:
         aliases = FIELD_ALIASES.get(t, [t])
         if t == 'purchase_value' and 'value' not in aliases: aliases.append('value')
         col = find_column_fuzzy(df_chunk, aliases)
@@ -290,6 +437,19 @@ def apply_report_labels(df, custom_mapping=None):
     if custom_mapping: mapping.update(custom_mapping)
     return df.rename(columns=mapping)
 
+def find_link_col_idx(columns):
+    link_col_idx = -1
+    for j, col in enumerate(columns):
+        if any(x in str(col).lower() for x in ["url", "link", "素材", "内容", "content"]): link_col_idx = j
+    return link_col_idx
+
+def row_link_label(title, i):
+    """素材/落地页表格里用「素材A」「落地页B」代替冗长的 URL"""
+    label_prefix = "素材" if "素材" in title else ("落地页" if "落地页" in title else "")
+    label_char = chr(65 + (i % 26))
+    if i >= 26: label_char += str(i // 26)
+    return f"{label_prefix}{label_char}"
+
 def add_df_to_word(doc, df, title, level=1):
     if df.empty: return
     doc.add_heading(title, level=level)
@@ -297,20 +457,16 @@ def add_df_to_word(doc, df, title, level=1):
     t.style = 'Table Grid'
     is_creative = "素材" in title
     is_landing = "落地页" in title
-    link_col_idx = -1
+    link_col_idx = find_link_col_idx(df.columns)
     for j, col in enumerate(df.columns):
         cell = t.cell(0, j)
         cell.text = str(col)
-        if any(x in str(col).lower() for x in ["url", "link", "素材", "内容", "content"]): link_col_idx = j
         for p in cell.paragraphs:
             for r in p.runs:
                 r.font.bold = True
                 r.font.size = Pt(8)
     for i in range(df.shape[0]):
-        label_prefix = "素材" if is_creative else ("落地页" if is_landing else "")
-        label_char = chr(65 + (i % 26))
-        if i >= 26: label_char += str(i // 26)
-        label_text = f"{label_prefix}{label_char}"
+        label_text = row_link_label(title, i)
         for j in range(df.shape[1]):
             val = df.iat[i, j]
             cell = t.cell(i+1, j)
@@ -318,7 +474,8 @@ def add_df_to_word(doc, df, title, level=1):
                 try:
                     p = cell.paragraphs[0]
                     url = str(val).strip()
-                    if len(url) > 5: add_hyperlink(p, url, label_text)
+                    if is_rollup_label(url): cell.text = url
+                    elif len(url) > 5: add_hyperlink(p, url, label_text)
                     else: cell.text = label_text
                 except: cell.text = label_text
             else:
@@ -330,71 +487,993 @@ def add_df_to_word(doc, df, title, level=1):
                 for r in p.runs: r.font.size = Pt(8)
     doc.add_paragraph("\n")
 
+# ==========================================
+# PART 2.1: 向量化异常检测 (rolling z-score / robust MAD)
+# ==========================================
+
+def _numeric_array(s):
+    return pd.to_numeric(s, errors='coerce').to_numpy(dtype=float)
+
+def parse_daily_dates(df, date_col):
+    """按天拆分的日期列解析成日期；没有该列或只有「2024-03-01 - 2024-03-31」这类整段时间范围时返回 None。
+    只接受单个日期 (可带时分秒)，避免 dateutil 把时间范围里的「- 2024」误读成时区偏移"""
+    if not date_col or date_col not in df.columns: return None
+    col = df[date_col]
+    if pd.api.types.is_datetime64_any_dtype(col):
+        dates = col
+    else:
+        txt = col.astype(str).str.strip()
+        single = txt.str.fullmatch(r"\d{4}[-/.]\d{1,2}[-/.]\d{1,2}(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?")
+        dates = pd.to_datetime(txt.where(single), errors='coerce', format='mixed')
+    return dates if dates.notna().any() else None
+
+def build_metric_cube(df, key_col=None, date_col=None, min_volume=None):
+    """把长表压成「对象 × 日期」的二维矩阵 (每个指标一张)，空格子为 NaN。
+    分子/分母列先按格子累加，再重算比率，避免对比率直接求和。
+    min_volume {指标: (列, 下限)}：该列格子累计值低于下限的比率置为 NaN (购买只有 0~3 次的 CPA/ROAS 没有参考意义)。"""
+    n = len(df)
+    if key_col and key_col in df.columns:
+        item_codes, items = pd.factorize(df[key_col].astype(str))
+    else:
+        item_codes, items = np.zeros(n, dtype=np.intp), pd.Index(["整体"])
+    dates = parse_daily_dates(df, date_col)
+    if dates is not None:
+        day_codes, days = pd.factorize(dates.dt.normalize(), sort=True)
+    else:
+        # 没有日期列，或是「2024-03-01 - 2024-03-31」这类整段时间范围：只做横截面
+        day_codes, days = np.zeros(n, dtype=np.intp), pd.Index(["-"])
+
+    valid = (item_codes >= 0) & (day_codes >= 0)
+    n_items, n_days = len(items), len(days)
+    flat = item_codes[valid] * n_days + day_codes[valid]
+    size = n_items * n_days
+
+    def _sum(col):
+        vals = np.nan_to_num(_numeric_array(df[col])[valid])
+        return np.bincount(flat, weights=vals, minlength=size).reshape(n_items, n_days)
+
+    filled = np.bincount(flat, minlength=size).reshape(n_items, n_days) > 0
+    sums = {}
+    cube = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for metric, (num, den, _) in ANOMALY_METRICS.items():
+            if num in df.columns and (den is None or den in df.columns):
+                if num not in sums: sums[num] = _sum(num)
+                if den is None:
+                    mat = sums[num].copy()
+                else:
+                    if den not in sums: sums[den] = _sum(den)
+                    mat = np.where(sums[den] > 0, sums[num] / sums[den], np.nan)
+            elif metric in df.columns:
+                # 缺少分子/分母时退回到原始比率列的格子均值
+                mat = _sum(metric) / np.bincount(flat, minlength=size).reshape(n_items, n_days)
+            else:
+                continue
+            mat[~filled] = np.nan
+            if metric in (min_volume or {}) and min_volume[metric][0] in df.columns:
+                vol_col, floor = min_volume[metric]
+                if vol_col not in sums: sums[vol_col] = _sum(vol_col)
+                mat[sums[vol_col] < floor] = np.nan
+            cube[metric] = mat
+    return items, days, cube
+
+def rolling_zscore(mat, window, min_periods):
+    """逐行(对象)沿日期轴计算 z-score：当天值 vs 前 window 天(不含当天)的均值/标准差。
+    窗口只有几天时样本标准差很不稳定，直接当正态 z 用会把大量噪声判成异常；
+    因此先算预测区间的 t 统计量 (x - 均值) / (s·√(1 + 1/n))，自由度 n-1，
+    再用 Wallace 近似换算成同尾概率的正态分数，阈值仍可按 z 理解。
+    通过累积和一次性算出所有窗口，无 Python 循环。返回 (z, 窗口均值)。"""
+    finite = np.isfinite(mat)
+    x = np.where(finite, mat, 0.0)
+    pad = ((0, 0), (1, 0))
+    c1 = np.pad(np.cumsum(x, axis=1), pad)
+    c2 = np.pad(np.cumsum(x * x, axis=1), pad)
+    cn = np.pad(np.cumsum(finite, axis=1), pad)
+    t = np.arange(mat.shape[1])
+    lo = np.maximum(t - window, 0)
+    s1 = c1[:, t] - c1[:, lo]
+    s2 = c2[:, t] - c2[:, lo]
+    cnt = cn[:, t] - cn[:, lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = s1 / cnt
+        var = (s2 - cnt * mean * mean) / (cnt - 1)
+        std = np.sqrt(np.clip(var, 0, None))
+        # 标准差极小(几乎恒定)时不打分，避免除零放大
+        ok = finite & (cnt >= min_periods) & (std > 1e-9 * np.maximum(np.abs(mean), 1.0))
+        t_stat = (mat - mean) / (std * np.sqrt(1 + 1 / cnt))
+        dof = cnt - 1
+        z = np.sign(t_stat) * np.sqrt(dof * np.log1p(t_stat * t_stat / dof)) * (8 * dof + 1) / (8 * dof + 3)
+        z = np.where(ok, z, np.nan)
+    return z, mean
+
+def robust_zscore(mat, axis=0):
+    """横截面 robust z-score：0.6745 * (x - median) / MAD。返回 (z, 中位数)。"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        med = np.nanmedian(mat, axis=axis, keepdims=True)
+        mad = np.nanmedian(np.abs(mat - med), axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(mad > 0, 0.6745 * (mat - med) / mad, np.nan)
+    return z, np.broadcast_to(med, mat.shape)
+
+def detect_anomalies(df, sheet_name, config=None):
+    """对单个 Sheet 的所有对象、所有日期、所有指标一次性打分，返回被标记的异常明细。
+    - 有日期列：每个对象沿时间轴做 rolling z-score
+    - 对象数足够：每一天在对象之间做 robust MAD（花费取 log1p，压缩长尾）"""
+    cfg = {**ANOMALY_CONFIG, **(config or {})}
+    key_col = next((c for c in ['dimension_item', 'content_item'] if c in df.columns), None)
+    items, days, cube = build_metric_cube(df, key_col, 'date_range', cfg['min_volume'])
+    has_dates = isinstance(days, pd.DatetimeIndex)
+
+    frames = []
+    for metric, mat in cube.items():
+        higher_better = ANOMALY_METRICS[metric][2]
+        checks = []
+        if len(days) > cfg['min_periods']:
+            z, ref = rolling_zscore(mat, cfg['window'], cfg['min_periods'])
+            checks.append(("rolling z-score", z, ref, cfg['z_threshold']))
+        if len(items) >= cfg['min_items']:
+            base = np.log1p(np.clip(mat, 0, None)) if metric == 'spend' else mat
+            z, ref = robust_zscore(base, axis=0)
+            if metric == 'spend': ref = np.expm1(ref)
+            checks.append(("robust MAD", z, ref, cfg['mad_threshold']))
+
+        for method, z, ref, threshold in checks:
+            with np.errstate(invalid='ignore'):
+                ii, dd = np.nonzero(np.abs(z) >= threshold)
+            if len(ii) == 0: continue
+            scores = z[ii, dd]
+            up = scores > 0
+            if higher_better is None: verdict = np.where(up, "⚠️ 异常偏高", "⚠️ 异常偏低")
+            elif higher_better: verdict = np.where(up, "✅ 异常偏高", "⚠️ 异常偏低")
+            else: verdict = np.where(up, "⚠️ 异常偏高", "✅ 异常偏低")
+            frames.append(pd.DataFrame({
+                "Source_Sheet": sheet_name,
+                "item": np.asarray(items)[ii],
+                "date": np.asarray(days.strftime("%Y-%m-%d") if has_dates else days)[dd],
+                "metric": metric,
+                "value": mat[ii, dd],
+                "reference": ref[ii, dd],
+                "score": scores,
+                "severity": np.abs(scores) / threshold,
+                "method": method,
+                "verdict": verdict,
+            }))
+    if not frames: return pd.DataFrame()
+    res = pd.concat(frames, ignore_index=True)
+    return res.sort_values('severity', ascending=False, kind='stable').reset_index(drop=True)
+
+def summarize_anomalies(df_anom, max_per_item=None):
+    """按严重度 (|score| / 所用方法的阈值，不同方法之间可比) 排序后去重：
+    同一对象同一天的多条标记 (不同指标 / 方法) 合并为最强的一条，flags 记合并的条数；每个对象最多保留 max_per_item 天"""
+    if df_anom.empty: return df_anom
+    max_per_item = max_per_item or ANOMALY_CONFIG['max_per_item']
+    df = df_anom.sort_values('severity', ascending=False, kind='stable')
+    cell = ['Source_Sheet', 'item', 'date']
+    df = df.assign(flags=df.groupby(cell, sort=False)['score'].transform('size')).drop_duplicates(cell)
+    df = df[df.groupby(['Source_Sheet', 'item'], sort=False).cumcount() < max_per_item]
+    return df.reset_index(drop=True)
+
+def format_anomalies(df_anom):
+    if df_anom.empty: return df_anom
+    return pd.DataFrame({
+        "来源": df_anom['Source_Sheet'],
+        "对象": df_anom['item'],
+        "日期": df_anom['date'],
+        "指标": df_anom['metric'].map(lambda m: REPORT_MAPPING.get(m, m.upper())),
+        "当前值": [format_cell(m, v) for m, v in zip(df_anom['metric'], df_anom['value'])],
+        "参考值": [format_cell(m, v) for m, v in zip(df_anom['metric'], df_anom['reference'])],
+        "偏离分数": df_anom['score'].round(2),
+        "检测方法": df_anom['method'],
+        "同日标记数": df_anom['flags'] if 'flags' in df_anom.columns else 1,
+        "结论": df_anom['verdict'],
+    })
+
+# ==========================================
+# PART 2.1.1: 排名置信区间与显著性
+# ==========================================
+
+def wilson_interval(successes, trials, z):
+    """比例的 Wilson 区间，全部按数组计算；trials <= 0 时为 NaN"""
+    n = np.asarray(trials, dtype=float)
+    k = np.clip(np.asarray(successes, dtype=float), 0, np.maximum(n, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = k / n
+        denom = 1 + z * z / n
+        center = (p + z * z / (2 * n)) / denom
+        half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denom
+    valid = n > 0
+    return np.where(valid, np.clip(center - half, 0, 1), np.nan), np.where(valid, np.clip(center + half, 0, 1), np.nan)
+
+def poisson_interval(counts, z):
+    """计数的 Poisson 区间 (Byar 近似)，k = 0 时下界为 0"""
+    k = np.clip(np.asarray(counts, dtype=float), 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lo = k * (1 - 1 / (9 * k) - z / (3 * np.sqrt(k))) ** 3
+        k1 = k + 1
+        hi = k1 * (1 - 1 / (9 * k1) + z / (3 * np.sqrt(k1))) ** 3
+    return np.where(k > 0, np.clip(lo, 0, None), 0.0), hi
+
+def rank_confidence(df, sheet_totals, z=None):
+    """对排名表的所有行一次性计算 CTR / CVR / CPA / ROAS 的置信区间，
+    并与各行所属 Sheet 的账户均值比较：区间整体优于均值记 +1，整体劣于均值记 -1。
+    ROAS 区间假设客单价固定，只考虑购买次数的 Poisson 波动。"""
+    z = z or SIGNIFICANCE_CONFIG['z']
+    col = lambda c: np.nan_to_num(_numeric_array(df[c])) if c in df.columns else np.zeros(len(df))
+    spend, clicks, impressions = col('spend'), col('clicks'), col('impressions')
+    purchases, value = col('purchases'), col('purchase_value')
+
+    sheets = df['Source_Sheet'].astype(str) if 'Source_Sheet' in df.columns else pd.Series("", index=df.index)
+    def account_avg(num, den):
+        ratios = {}
+        for sheet in sheets.unique():
+            t = sheet_totals.get(sheet, {})
+            ratios[sheet] = t.get(num, 0.0) / t[den] if t.get(den, 0) > 0 else np.nan
+        return sheets.map(ratios).to_numpy(dtype=float)
+
+    res = pd.DataFrame(index=df.index)
+    res['ctr_lo'], res['ctr_hi'] = wilson_interval(clicks, impressions, z)
+    res['cvr_lo'], res['cvr_hi'] = wilson_interval(purchases, clicks, z)
+    k_lo, k_hi = poisson_interval(purchases, z)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res['cpa_lo'] = np.where(spend > 0, spend / k_hi, np.nan)
+        res['cpa_hi'] = np.where((spend > 0) & (k_lo > 0), spend / k_lo, np.inf)
+        aov = np.where(purchases > 0, value / purchases, np.nan)
+        res['roas_lo'] = np.where(spend > 0, aov * k_lo / spend, np.nan)
+        res['roas_hi'] = np.where(spend > 0, aov * k_hi / spend, np.nan)
+
+    avg = {'ctr': account_avg('clicks', 'impressions'), 'cvr': account_avg('purchases', 'clicks'),
+           'cpa': account_avg('spend', 'purchases'), 'roas': account_avg('purchase_value', 'spend')}
+    for m, higher_better in [('ctr', True), ('cvr', True), ('cpa', False), ('roas', True)]:
+        lo, hi, a = res[f'{m}_lo'].to_numpy(), res[f'{m}_hi'].to_numpy(), avg[m]
+        with np.errstate(invalid='ignore'):
+            above, below = lo > a, hi < a
+        res[f'{m}_sig'] = np.where(above, 1, np.where(below, -1, 0)) * (1 if higher_better else -1)
+
+    sig = res[['ctr_sig', 'cvr_sig', 'cpa_sig', 'roas_sig']].to_numpy()
+    better, worse = (sig > 0).any(axis=1), (sig < 0).any(axis=1)
+    res['beats_account'] = better & ~worse
+    res['verdict'] = np.select([better & ~worse, worse & ~better, better & worse],
+                               ["✅ 显著优于账户均值", "⚠️ 显著低于账户均值", "⚖️ 有优有劣"], default="差异不显著")
+
+    # 「其他 (共 N 项)」是多个对象的合计，不是单个对象，区间与结论都不适用
+    key_col = next((c for c in ["content_item", "dimension_item"] if c in df.columns), None)
+    if key_col:
+        rollup = rollup_mask(df[key_col])
+        if rollup.any():
+            res.loc[rollup, [c for c in res.columns if c.endswith(('_lo', '_hi'))]] = np.nan
+            res.loc[rollup, [c for c in res.columns if c.endswith('_sig')]] = 0
+            res.loc[rollup, 'beats_account'] = False
+            res.loc[rollup, 'verdict'] = "-"
+    return res
+
+def format_confidence(ci):
+    """把数值区间转成报告里展示的字符串列"""
+    def fmt(key, lo, hi):
+        if pd.isna(lo): return "-"
+        return f"{format_cell(key, lo)} ~ {'∞' if np.isinf(hi) else format_cell(key, hi)}"
+    level = SIGNIFICANCE_CONFIG['level']
+    out = pd.DataFrame(index=ci.index)
+    for key, label in [('ctr', 'CTR'), ('cvr', 'CVR'), ('cpa', 'CPA'), ('roas', 'ROAS')]:
+        out[f"{label} {level} CI"] = [fmt(key, lo, hi) for lo, hi in zip(ci[f'{key}_lo'], ci[f'{key}_hi'])]
+    out["显著性结论"] = ci['verdict']
+    return out
+
+# ==========================================
+# PART 2.1.2: Top N 排名引擎 (部分选择 + 「其他」长尾汇总)
+# ==========================================
+
+def rollup_label(count):
+    return f"{ROLLUP_LABEL} (共 {int(count)} 项)"
+
+def is_rollup_label(val):
+    return isinstance(val, str) and re.fullmatch(ROLLUP_PATTERN, val) is not None
+
+def rollup_mask(keys):
+    return keys.astype(str).str.fullmatch(ROLLUP_PATTERN).fillna(False).to_numpy(dtype=bool)
+
+def rollup_item_count(keys):
+    """每行代表的对象数：普通行为 1，「其他」行为其汇总的对象数"""
+    return keys.astype(str).str.extract(ROLLUP_PATTERN, expand=False).astype(float).fillna(1).to_numpy()
+
+def top_n_positions(values, n, ascending=False):
+    """部分选择：np.partition 找到第 n 名的阈值 (O(N))，只对入选的 n 行排序。
+    NaN 排在最后；值相同按原顺序，结果与稳定排序后取 head(n) 一致"""
+    key = np.asarray(values, dtype=float)
+    key = np.where(np.isnan(key), np.inf, key if ascending else -key)
+    n = min(int(n), len(key))
+    if n <= 0: return np.array([], dtype=int)
+    kth = np.partition(key, n - 1)[n - 1]
+    less = np.flatnonzero(key < kth)
+    cand = np.concatenate([less, np.flatnonzero(key == kth)[:n - len(less)]])
+    return cand[np.lexsort((cand, key[cand]))]
+
+def build_rollup_row(tail, key_col):
+    """把长尾行汇总成一行：可加总列求和，ROLLUP_RATIOS 里的比率用汇总值重算，其余数值列按花费加权平均，文本列记「-」"""
+    count = rollup_item_count(tail[key_col]).sum()
+    if count <= 0: return None
+    num = lambda c: np.nan_to_num(_numeric_array(tail[c]))
+    sums = {c: float(num(c).sum()) for c in ADDITIVE_METRICS if c in tail.columns}
+    w = num('spend') if 'spend' in tail.columns else np.ones(len(tail))
+    row = {}
+    for c in tail.columns:
+        if c == key_col: row[c] = rollup_label(count)
+        elif c in sums: row[c] = sums[c]
+        elif c in ROLLUP_RATIOS and ROLLUP_RATIOS[c][0] in sums and ROLLUP_RATIOS[c][1] in sums:
+            n_col, d_col, mult = ROLLUP_RATIOS[c]
+            row[c] = sums[n_col] / sums[d_col] * mult if sums[d_col] > 0 else 0.0
+        elif c == 'Source_Sheet': row[c] = tail[c].iloc[0] if len(tail) else "-"
+        elif c in TEXT_COLS or not pd.api.types.is_numeric_dtype(tail[c]): row[c] = "-"
+        else:
+            vals = _numeric_array(tail[c]); ok = ~np.isnan(vals)
+            if w[ok].sum() > 0: row[c] = float((vals[ok] * w[ok]).sum() / w[ok].sum())
+            else: row[c] = float(vals[ok].mean()) if ok.any() else 0.0
+    return pd.DataFrame([row], index=[ROLLUP_LABEL], columns=tail.columns)
+
+def compute_rankings(df, specs, key_col):
+    """同一分区的所有排名一次算完 (specs 见 RANKING_CONFIG)，返回 {排名名称: DataFrame}。
+    数值列只转换一次，每个排名只做部分选择，不复制、不全表排序；已有的「其他」行不参与排名，并入新的长尾汇总。"""
+    is_rollup = rollup_mask(df[key_col]) if key_col in df.columns else np.zeros(len(df), dtype=bool)
+    body = np.flatnonzero(~is_rollup)
+    arrays = {}
+    def col(c):
+        if c not in arrays:
+            arrays[c] = _numeric_array(df[c])[body] if c in df.columns else np.full(len(body), np.nan)
+        return arrays[c]
+    spend_all = np.nan_to_num(_numeric_array(df['spend'])) if 'spend' in df.columns else np.zeros(len(df))
+    spend_total = float(spend_all.sum())
+
+    out = {}
+    for name, spec in specs.items():
+        cand = np.arange(len(body))
+        if spec.get('where'):
+            with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                mask = np.asarray(spec['where'](col), dtype=bool)
+            if mask.any() or not spec.get('fallback'): cand = cand[mask]
+        picked = body[cand[top_n_positions(col(spec['metric'])[cand], spec['n'], spec.get('ascending', False))]]
+        frame = df.iloc[picked].copy()
+
+        if spec.get('rollup') and key_col in df.columns:
+            tail = df.iloc[np.setdiff1d(np.arange(len(df)), picked)]
+            # 长尾只剩一个对象时原样保留，不把真实对象藏在「其他 (共 1 项)」后面
+            if rollup_item_count(tail[key_col]).sum() == 1: frame = pd.concat([frame, tail])
+            else:
+                row = build_rollup_row(tail, key_col)
+                if row is not None: frame = pd.concat([frame, row])
+
+        if spec.get('share'):
+            share = np.nan_to_num(_numeric_array(frame['spend'])) / spend_total if spend_total > 0 else 0.0
+            frame = frame.assign(spend_share=share)
+        out[name] = frame
+    return out
+
+# ==========================================
+# PART 2.2: 行业 Benchmark 库 (进程内常驻 + 热更新)
+# ==========================================
+
+def read_upload_bytes(file_obj):
+    """兼容 Streamlit UploadedFile / 文件路径 / 普通文件对象，读出全部字节"""
+    if isinstance(file_obj, (str, os.PathLike)):
+        with open(file_obj, 'rb') as f: return f.read()
+    if hasattr(file_obj, 'getvalue'): return file_obj.getvalue()
+    pos = file_obj.tell() if hasattr(file_obj, 'tell') else None
+    data = file_obj.read()
+    if pos is not None: file_obj.seek(pos)
+    return data
+
+class ContentCache:
+    """按内容哈希缓存解析结果的小型 LRU，线程安全 (Streamlit 每个会话一个线程)"""
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def get_or_build(self, data, builder, salt=""):
+        key = self.digest(data) + salt
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        value = builder(data)
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.max_entries: self._data.popitem(last=False)
+        return value
+
+def _read_benchmark_table(path_or_buffer, name=""):
+    if str(name or path_or_buffer).lower().endswith(('.csv', '.tsv')):
+        return pd.read_csv(path_or_buffer, sep='\t' if str(name or path_or_buffer).lower().endswith('.tsv') else ',')
+    return pd.read_excel(path_or_buffer)
+
+class BenchmarkLibrary:
+    """把 BENCHMARK_DIR 下的全部基准表一次性解析成 (行业, 国家) -> {指标: [值, 越高越好]} 的索引。
+    每次查询前只比对文件的 mtime/size 签名，有变化才重新加载；上传的表按内容哈希缓存。"""
+    def __init__(self, root=BENCHMARK_DIR):
+        self.root = root
+        self._index = {}
+        self._signature = None
+        self._lock = threading.Lock()
+        self._uploads = ContentCache()
+
+    def _scan(self):
+        if not os.path.isdir(self.root): return ()
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.lower().endswith(('.xlsx', '.xls', '.csv', '.tsv')) and not entry.name.startswith(('~$', '.')):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(entries))
+
+    def _build_index(self, files):
+        index = {}
+        for path, _, _ in files:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            parts = [p.strip() for p in stem.split('_', 1)]
+            file_vertical = parts[0] or BENCHMARK_ALL
+            file_country = parts[1] if len(parts) > 1 and parts[1] else BENCHMARK_ALL
+            try: df = _read_benchmark_table(path)
+            except Exception as e:
+                st.warning(f"Benchmark 文件读取失败 {os.path.basename(path)}: {e}")
+                continue
+            v_col = find_column_fuzzy(df, ['vertical', 'industry', '行业'])
+            c_col = find_column_fuzzy(df, ['country', 'region', '国家', '地区'])
+            keys = pd.DataFrame({
+                'v': df[v_col].fillna(file_vertical).astype(str).str.strip() if v_col else file_vertical,
+                'c': df[c_col].fillna(file_country).astype(str).str.strip() if c_col else file_country,
+            }, index=df.index)
+            for (vertical, country), idx in keys.groupby(['v', 'c'], sort=False).groups.items():
+                values = extract_benchmark_values(df.loc[idx])
+                if values: index.setdefault((vertical, country), {}).update(values)
+        return index
+
+    def _ensure_fresh(self):
+        files = self._scan()
+        if files == self._signature: return
+        with self._lock:
+            if files != self._signature:
+                self._index = self._build_index(files)
+                self._signature = files
+
+    def keys(self):
+        self._ensure_fresh()
+        return sorted(self._index)
+
+    def verticals(self):
+        return sorted({v for v, _ in self.keys()})
+
+    def countries(self, vertical=None):
+        return sorted({c for v, c in self.keys() if vertical in (None, v)})
+
+    def get(self, vertical=BENCHMARK_ALL, country=BENCHMARK_ALL):
+        """按 (行业, 国家) 取基准，逐级回退到 ALL，最后回退到 DEFAULT_BENCHMARK_TARGETS"""
+        self._ensure_fresh()
+        targets = {k: list(v) for k, v in DEFAULT_BENCHMARK_TARGETS.items()}
+        for key in [(BENCHMARK_ALL, BENCHMARK_ALL), (BENCHMARK_ALL, country), (vertical, BENCHMARK_ALL), (vertical, country)]:
+            for metric, v in self._index.get(key, {}).items(): targets[metric] = list(v)
+        return targets
+
+    def parse_upload(self, file_obj):
+        name = getattr(file_obj, 'name', str(file_obj) if isinstance(file_obj, (str, os.PathLike)) else "")
+        values = self._uploads.get_or_build(read_upload_bytes(file_obj),
+                                            lambda data: extract_benchmark_values(_read_benchmark_table(io.BytesIO(data), name)))
+        return {k: list(v) for k, v in values.items()}
+
+@st.cache_resource
+def get_benchmark_library():
+    return BenchmarkLibrary()
+
+def resolve_benchmark_targets(bench_file=None, bench_key=None):
+    """优先使用上传的基准表；否则按 (行业, 国家) 从常驻库中选取"""
+    library = get_benchmark_library()
+    if bench_file:
+        try: return library.parse_upload(bench_file)
+        except Exception: pass
+    vertical, country = bench_key or (BENCHMARK_ALL, BENCHMARK_ALL)
+    return library.get(vertical, country)
+
+# ==========================================
+# PART 2.3: 内存预算
+# ==========================================
+
+class MemoryBudgetExceeded(RuntimeError):
+    pass
+
+def current_rss_bytes():
+    """进程当前常驻内存 (Linux 读 /proc/self/statm)；取不到时返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class MemoryBudget:
+    """按单个任务自己的用量做预算，超过上限时抛出 MemoryBudgetExceeded 而不是等到 OOM。
+    用量 = 任务持有的 DataFrame (held)，加上当前阶段的瞬时分配。
+    Streamlit 的各个会话是同一进程里的线程，进程 RSS 是所有任务的总和，不能当成单个任务的用量；
+    因此 RSS 只在一个阶段内部取增量 (begin 记录起点)，用来覆盖 openpyxl 工作簿、CSV 字符串块、
+    python-docx 文档这些 DataFrame 以外的分配，阶段之间不累计。
+    分配密集的阶段开始前传入预估新增量 expected，「已用 + 预估」超限就不再执行该阶段；阶段结束后再按实测复核。
+    RSS 取不到的平台只按 held 统计。"""
+    def __init__(self, limit_mb=None):
+        self.limit_bytes = int(limit_mb * 1024 * 1024) if limit_mb else None
+        self.stage_rss = None
+        self.stage_held = 0
+        self.peak_bytes = 0
+
+    def begin(self, held=0):
+        """阶段开始：记下此刻的 RSS 与任务持有量，阶段内的瞬时分配按与它的差值计"""
+        self.stage_rss, self.stage_held = current_rss_bytes(), held
+
+    def used_bytes(self, held=0):
+        rss = current_rss_bytes()
+        if rss is None or self.stage_rss is None: return held
+        # 分配器会复用已释放的内存，RSS 不一定上涨，因此至少按持有的数据计
+        return max(self.stage_held + rss - self.stage_rss, held)
+
+    def check(self, stage, expected=0, held=0):
+        used = self.used_bytes(held)
+        self.peak_bytes = max(self.peak_bytes, used)
+        nbytes = used + expected
+        if self.limit_bytes and nbytes > self.limit_bytes:
+            raise MemoryBudgetExceeded(
+                f"任务内存超出预算：阶段「{stage}」已用约 {used / 2**20:,.1f} MB，预计再需 {expected / 2**20:,.1f} MB，"
+                f"上限 {self.limit_bytes / 2**20:,.0f} MB。请拆分数据文件或调高内存上限。")
+
+def frame_nbytes(*dfs):
+    return int(sum(df.memory_usage(index=True, deep=True).sum() for df in dfs if df is not None))
+
+def estimate_sheet_nbytes(xls, sheet_name):
+    """解析前按工作表维度 (行 × 列) 粗估内存；拿不到维度时返回 0"""
+    try:
+        ws = xls.book[sheet_name]
+        return int((ws.max_row or 0) * (ws.max_column or 0) * MEMORY_CONFIG['xlsx_bytes_per_cell'])
+    except Exception:
+        return 0
+
+def optimize_frame_memory(df):
+    """计数列降为最小整型 (仅当全部为整数时)，低基数文本维度转为 category；金额/比率保持 float64 不损失精度"""
+    for col in MEMORY_CONFIG['count_cols']:
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            vals = df[col].to_numpy(dtype=float)
+            if np.isfinite(vals).all() and (vals == np.round(vals)).all():
+                df[col] = pd.to_numeric(vals.astype(np.int64), downcast='integer')
+    for col in MEMORY_CONFIG['category_cols']:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype) and len(df):
+            if df[col].nunique(dropna=False) / len(df) < MEMORY_CONFIG['category_max_ratio']:
+                df[col] = df[col].astype('category')
+    return df
+
+# ==========================================
+# PART 2.4: CSV / zip 分块读取与流式聚合
+# ==========================================
+
+def source_name(raw_file):
+    if isinstance(raw_file, (str, os.PathLike)): return os.fspath(raw_file)
+    return getattr(raw_file, 'name', '') or ''
+
+def is_csv_source(raw_file):
+    return source_name(raw_file).lower().endswith(CSV_CONFIG['extensions'])
+
+def match_sheet_name(filename):
+    stem = os.path.splitext(os.path.basename(filename))[0].strip()
+    if stem in SHEET_MAPPINGS: return stem
+    for name in sorted(SHEET_MAPPINGS, key=len, reverse=True):
+        if name in stem: return name
+    return None
+
+def iter_csv_sources(raw_file):
+    """返回 [(sheet_name, 文件名, 打开函数, 解压后字节数)]；打开函数每次返回一个新的二进制流，便于换编码重读"""
+    name = source_name(raw_file)
+    if isinstance(raw_file, (str, os.PathLike)): opener = lambda: open(raw_file, 'rb')
+    else: opener = lambda: io.BytesIO(read_upload_bytes(raw_file))
+    if not name.lower().endswith('.zip'):
+        sheet = match_sheet_name(name)
+        if not sheet: raise ValueError(f"无法根据文件名「{os.path.basename(name)}」识别对应的 Sheet，请以 Sheet 名命名，如「素材.csv」")
+        if isinstance(raw_file, (str, os.PathLike)): size = os.path.getsize(raw_file)
+        else: size = getattr(raw_file, 'size', None) or len(read_upload_bytes(raw_file))
+        return [(sheet, name, opener, size)]
+
+    sources = []
+    with opener() as fh, zipfile.ZipFile(fh) as zf:
+        members = [(i.filename, i.file_size) for i in zf.infolist()
+                   if not i.is_dir() and i.filename.lower().endswith(('.csv', '.tsv')) and not i.filename.startswith('__MACOSX')]
+    for member, size in members:
+        sheet = match_sheet_name(member)
+        if not sheet: continue
+        @contextlib.contextmanager
+        def open_member(member=member):
+            with opener() as fh, zipfile.ZipFile(fh) as zf, zf.open(member) as stream:
+                yield stream
+        sources.append((sheet, member, open_member, size))
+    if not sources: raise ValueError("压缩包中没有可识别的 CSV 文件，请以 Sheet 名命名，如「素材.csv」")
+    return sources
+
+class StreamingSheetAggregator:
+    """逐块消费同一 Sheet 的数据，内存只与「对象数」有关而与行数无关：
+    - ADDITIVE_METRICS 的总和持续累加 (totals)
+    - 有维度/日期列的 Sheet：按维度聚合，可加总列求和；ROLLUP_RATIOS 里的比率由求和后的分子/分母重算，
+      其余比率列按花费加权平均。TOPN_SHEETS 同样按对象聚合，Top N 截断在 _finish_sheet 按对象总量做
+    - 无维度列的小表：原样保留"""
+    def __init__(self, sheet_name, keys=None):
+        self.sheet_name = sheet_name
+        self.totals = dict.fromkeys(ADDITIVE_METRICS, 0.0)
+        self.columns = None
+        # 不指定时按 CSV_CONFIG['group_keys'] 中实际存在的列聚合
+        self.group_keys = keys
+        self.keys = []
+        self.state = None
+
+    def add(self, chunk):
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            self.keys = [k for k in (self.group_keys or CSV_CONFIG['group_keys']) if k in chunk.columns]
+        for t in ADDITIVE_METRICS:
+            if t in chunk.columns: self.totals[t] += float(chunk[t].sum())
+
+        if self.keys:
+            partial = self._aggregate(self._expand(chunk))
+            self.state = partial if self.state is None else self._aggregate(pd.concat([self.state, partial]).reset_index())
+        else:
+            self.state = chunk if self.state is None else pd.concat([self.state, chunk], ignore_index=True)
+
+    def _ratio_cols(self, df):
+        return [c for c in self.columns if c not in self.keys and c not in ADDITIVE_METRICS
+                and c not in TEXT_COLS and c in df.columns]
+
+    def _expand(self, chunk):
+        """把比率列拆成可累加的 Σv·w / Σw / Σv / 行数，w 为花费；空值 (如「-」) 不计入"""
+        out = chunk.copy()
+        w = chunk['spend'] if 'spend' in chunk.columns else pd.Series(1.0, index=chunk.index)
+        for c in self._ratio_cols(chunk):
+            v = pd.to_numeric(chunk[c], errors='coerce')
+            ok = v.notna()
+            out[c] = v
+            out[f'__vw_{c}'] = (v * w).where(ok, 0.0)
+            out[f'__w_{c}'] = w.where(ok, 0.0)
+            out[f'__n_{c}'] = ok.astype(int)
+        return out
+
+    def _aggregate(self, df):
+        agg = {}
+        for c in df.columns:
+            if c in self.keys: continue
+            if c in TEXT_COLS: agg[c] = 'first'
+            else: agg[c] = 'sum'
+        return df.groupby(self.keys, sort=False, dropna=False).agg(agg)
+
+    def nbytes(self):
+        return frame_nbytes(self.state)
+
+    def result(self):
+        if self.state is None: return pd.DataFrame(columns=self.columns or [])
+        df = self.state
+        if self.keys:
+            df = df.reset_index()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for c in self._ratio_cols(df):
+                    vw, w, n = df[f'__vw_{c}'], df[f'__w_{c}'], df[f'__n_{c}']
+                    merged = np.where(w > 0, vw / w.where(w > 0), df[c] / n)
+                    if c in ROLLUP_RATIOS and ROLLUP_RATIOS[c][0] in df.columns and ROLLUP_RATIOS[c][1] in df.columns:
+                        num_col, den_col, mult = ROLLUP_RATIOS[c]
+                        den = df[den_col].to_numpy(dtype=float)
+                        merged = np.where(den > 0, df[num_col].to_numpy(dtype=float) / np.where(den > 0, den, 1) * mult, merged)
+                    # 单行的对象直接保留原值，与 Excel 路径逐行读取的结果一致
+                    df[c] = np.where(n == 1, df[c], merged)
+            df = df[self.columns]
+        return df.reset_index(drop=True)
+
+# ==========================================
+# PART 2.5: HTML 报告预览 (直接由 final_json 渲染)
+# ==========================================
+
+HTML_REPORT_STYLE = """
+<style>
+.ad-report { font-family: -apple-system, BlinkMacSystemFont, "PingFang SC", sans-serif; color: #333; font-size: 13px; }
+.ad-report h1 { text-align: center; color: #662D8C; margin-bottom: 0.2rem; }
+.ad-report .meta { text-align: center; color: #888; margin-bottom: 1.5rem; }
+.ad-report h2 { color: #662D8C; border-left: 4px solid #ED1E79; padding-left: 8px; margin-top: 1.6rem; }
+.ad-report h3 { color: #4A4A4A; margin-top: 1.2rem; }
+.ad-report table { border-collapse: collapse; width: 100%; margin: 0.4rem 0 1rem; }
+.ad-report th, .ad-report td { border: 1px solid #e3d9ee; padding: 4px 8px; text-align: left; white-space: pre-line; }
+.ad-report th { background: #f5ebff; cursor: pointer; user-select: none; position: sticky; top: 0; }
+.ad-report th:hover { background: #ecdcff; }
+.ad-report th.asc::after { content: " ▲"; } .ad-report th.desc::after { content: " ▼"; }
+.ad-report tr:nth-child(even) td { background: #fcf9ff; }
+.ad-report .good { color: #008000; font-weight: 600; } .ad-report .bad { color: #ff0000; font-weight: 600; }
+.ad-report a { color: #0000FF; }
+</style>
+"""
+
+HTML_REPORT_SCRIPT = """
+<script>
+document.querySelectorAll('.ad-report table').forEach(function (table) {
+  table.querySelectorAll('th').forEach(function (th, idx) {
+    th.addEventListener('click', function () {
+      var asc = !th.classList.contains('asc');
+      table.querySelectorAll('th').forEach(function (h) { h.classList.remove('asc', 'desc'); });
+      th.classList.add(asc ? 'asc' : 'desc');
+      var tbody = table.tBodies[0];
+      var key = function (row) {
+        var text = row.cells[idx].innerText.trim();
+        var num = parseFloat(text.replace(/[,$%+∞]/g, ''));
+        return isNaN(num) ? text : num;
+      };
+      Array.from(tbody.rows).sort(function (a, b) {
+        var x = key(a), y = key(b);
+        var cmp = (typeof x === 'number' && typeof y === 'number') ? x - y : String(x).localeCompare(String(y));
+        return asc ? cmp : -cmp;
+      }).forEach(function (row) { tbody.appendChild(row); });
+    });
+  });
+});
+</script>
+"""
+
+def _html_table(records, title):
+    if not records: return ""
+    columns = list(records[0].keys())
+    link_col_idx = find_link_col_idx(columns) if ("素材" in title or "落地页" in title) else -1
+    head = "".join(f"<th>{html.escape(str(c))}</th>" for c in columns)
+    rows = []
+    for i, rec in enumerate(records):
+        cells = []
+        for j, col in enumerate(columns):
+            val = "" if rec.get(col) is None else str(rec.get(col))
+            if j == link_col_idx:
+                label = html.escape(row_link_label(title, i))
+                url = val.strip()
+                if is_rollup_label(url):
+                    cells.append(f"<td>{html.escape(url)}</td>")
+                elif url.lower().startswith(("http://", "https://")):
+                    cells.append(f'<td><a href="{html.escape(url, quote=True)}" target="_blank" title="{html.escape(url, quote=True)}">{label}</a></td>')
+                else:
+                    cells.append(f"<td>{label}</td>")
+                continue
+            css = ""
+            if "结论" in str(col):
+                if "✅" in val: css = ' class="good"'
+                if "⚠️" in val: css = ' class="bad"'
+            cells.append(f"<td{css}>{html.escape(val)}</td>")
+        rows.append("<tr>" + "".join(cells) + "</tr>")
+    return f"<table><thead><tr>{head}</tr></thead><tbody>{''.join(rows)}</tbody></table>"
+
+def _html_section(key, value, level):
+    title = REPORT_SECTION_TITLES.get(key, key)
+    tag = "h2" if level == 1 else "h3"
+    if isinstance(value, list) and not all(isinstance(v, dict) for v in value):
+        return f"<p><b>{html.escape(title)}</b>：{html.escape('、'.join(map(str, value)))}</p>"
+    if isinstance(value, list):
+        return f"<{tag}>{html.escape(title)}</{tag}>" + (_html_table(value, title) if value else "<p>-</p>")
+    if isinstance(value, dict):
+        parts = [f"<{tag}>{html.escape(title)}</{tag}>"]
+        for sub_key, sub_value in value.items():
+            if isinstance(sub_value, (list, dict)): parts.append(_html_section(sub_key, sub_value, level + 1))
+            else: parts.append(f"<p><b>{html.escape(REPORT_SECTION_TITLES.get(sub_key, sub_key))}</b>：{html.escape(str(sub_value))}</p>")
+        return "".join(parts)
+    return f"<p><b>{html.escape(title)}</b>：{html.escape(str(value))}</p>"
+
+def render_html_report(final_json):
+    """把 final_json 渲染成带样式、可点击表头排序的 HTML；结论列着色，素材/落地页链接可点击"""
+    parts = [HTML_REPORT_STYLE, '<div class="ad-report">',
+             f"<h1>{html.escape(str(final_json.get('report_title', '广告投放深度分析报告')))}</h1>",
+             f"<div class=\"meta\">生成日期：{html.escape(str(final_json.get('generated_at', '-')))}</div>"]
+    for key, value in final_json.items():
+        if key in ("report_title", "generated_at"): continue
+        parts.append(_html_section(key, value, level=1))
+    parts.append("</div>")
+    parts.append(HTML_REPORT_SCRIPT)
+    return "".join(parts)
+
 # ==========================================
 # PART 3: 主逻辑类
 # ==========================================
 
 class AdReportProcessor:
-    def __init__(self, raw_file, bench_file=None):
+    def __init__(self, raw_file, bench_file=None, bench_key=None, memory_limit_mb=None):
         self.raw_file = raw_file
         self.bench_file = bench_file
+        self.bench_key = bench_key
         self.processed_dfs = {}
         self.merged_dfs = {}
+        self.anomaly_dfs = {}
+        self.sheet_totals = {}
+        # 各 Sheet 花费 > 0 的对象数 (截断前)，Top N 截断后的表里已数不全
+        self.active_counts = {}
+        # 多期对比用的各版块指标 (截断前、按对象汇总)；置为 {} 才会记录，见 run_etl_cached
+        self.compare_frames = None
         self.final_json = {}
-        self.doc = Document()
+        # Word 内容先记录为 blocks，用户真正需要 DOCX 时再由 build_docx 渲染
+        self.word_blocks = []
+        self.doc = None
+        # 设置了内存上限即进入低内存模式：下游消费完的中间结果立即释放
+        self.low_memory = bool(memory_limit_mb)
+        self.budget = MemoryBudget(memory_limit_mb)
+
+    def release_sources(self):
+        """报告生成后只保留预览与导出要用的 final_json / word_blocks / merged_dfs，释放原始上传与中间结果"""
+        self.raw_file = self.bench_file = None
+        self.processed_dfs = {}
+        self.anomaly_dfs = {}
+        self.doc = None
+
+    def held_nbytes(self, *extra):
+        frames = [*self.processed_dfs.values(), *self.merged_dfs.values(), *self.anomaly_dfs.values(), *extra]
+        return frame_nbytes(*frames)
 
     def process_etl(self):
+        if is_csv_source(self.raw_file): self._load_csv_sources()
+        else: self._load_excel_sheets()
+        self._merge_master_tables()
+
+    def _load_excel_sheets(self):
         xls = pd.ExcelFile(self.raw_file)
         for sheet_name, mapping in SHEET_MAPPINGS.items():
             if sheet_name in xls.sheet_names:
+                self.budget.begin(self.held_nbytes())
+                self.budget.check(f"读取 {sheet_name}", expected=estimate_sheet_nbytes(xls, sheet_name), held=self.held_nbytes())
                 df = pd.read_excel(xls, sheet_name=sheet_name)
-                final_cols = {}
-                for std_col, raw_col_options in mapping.items():
-                    matched_col = None
-                    for option in raw_col_options:
-                        if option in df.columns: matched_col = option; break
-                        if not matched_col:
-                            for df_col in df.columns:
-                                if option.replace(" ", "") == df_col.replace(" ", ""): matched_col = df_col; break
-                        if matched_col: break
-                    if matched_col: final_cols[std_col] = matched_col
+                self.budget.check(f"读取 {sheet_name}", held=self.held_nbytes(df))
+                final_cols = match_sheet_columns(df.columns, mapping)
 
                 if final_cols:
                     df_clean = df[list(final_cols.values())].rename(columns={v: k for k, v in final_cols.items()})
-                    text_cols = ['date_range', 'anomaly_metric_name', 
-                                 'converting_keywords', 'converting_countries', 'converting_genders', 'converting_ages', 
-                                 'custom_audience_settings', 'dimension_item', 'content_item']
-                    
                     for col in df_clean.columns:
-                        if col not in text_cols:
+                        if col not in TEXT_COLS:
                             df_clean[col] = df_clean[col].apply(clean_numeric)
-
-                    if sheet_name in ["素材", "落地页", "受众组"]:
-                        if "spend" in df_clean.columns:
-                            df_clean = df_clean.sort_values("spend", ascending=False).head(10)
-
-                    df_clean["Source_Sheet"] = sheet_name
-                    self.processed_dfs[sheet_name] = df_clean
-
+                    self.sheet_totals[sheet_name] = {t: float(pd.to_numeric(df_clean[t], errors='coerce').sum())
+                                                     for t in ADDITIVE_METRICS if t in df_clean.columns}
+                    self._finish_sheet(sheet_name, df_clean)
+                del df
+        xls.close()
+
+    def _load_csv_sources(self):
+        """CSV / TSV / zip：按块读取并流式聚合，任何时刻只驻留一个块 + 聚合状态"""
+        by_sheet = {}
+        for sheet_name, member, open_stream, size in iter_csv_sources(self.raw_file):
+            by_sheet.setdefault(sheet_name, []).append((member, open_stream, size))
+        for sheet_name, mapping in SHEET_MAPPINGS.items():
+            if sheet_name not in by_sheet: continue
+            agg = StreamingSheetAggregator(sheet_name)
+            for member, open_stream, size in by_sheet[sheet_name]:
+                self._stream_csv(agg, mapping, member, open_stream, size)
+            if agg.columns is None: continue
+            self.sheet_totals[sheet_name] = {t: v for t, v in agg.totals.items() if t in agg.columns}
+            self._finish_sheet(sheet_name, agg.result())
+
+    def _stream_csv(self, agg, mapping, member, open_stream, size):
+        sep = '\t' if member.lower().endswith('.tsv') else ','
+        for i, encoding in enumerate(CSV_CONFIG['encodings']):
+            snapshot = (agg.totals.copy(), agg.columns, agg.keys, agg.state)
+            # 第一块读入前：按文件大小预估，不超过一整块的量 (列数未知时按映射列数)
+            first_chunk = min(size * MEMORY_CONFIG['csv_bytes_per_text_byte'],
+                              CSV_CONFIG['chunk_rows'] * len(mapping) * MEMORY_CONFIG['csv_bytes_per_cell'])
+            self.budget.begin(self.held_nbytes() + agg.nbytes())
+            self.budget.check(f"流式读取 {agg.sheet_name}", expected=first_chunk, held=self.held_nbytes() + agg.nbytes())
+            try:
+                with open_stream() as fh:
+                    reader = pd.read_csv(fh, sep=sep, dtype=str, encoding=encoding, chunksize=CSV_CONFIG['chunk_rows'])
+                    final_cols = None
+                    for chunk in reader:
+                        if final_cols is None:
+                            final_cols = match_sheet_columns(chunk.columns, mapping)
+                            if not final_cols: return
+                        df_clean = pd.DataFrame({std: chunk[raw] for std, raw in final_cols.items()})
+                        for col in df_clean.columns:
+                            if col not in TEXT_COLS: df_clean[col] = clean_numeric_series(df_clean[col])
+                        agg.add(df_clean)
+                        # 读下一块之前：当前块仍被引用，下一块同样大小
+                        self.budget.check(f"流式读取 {agg.sheet_name}", expected=chunk.size * MEMORY_CONFIG['csv_bytes_per_cell'],
+                                          held=self.held_nbytes(chunk, df_clean) + agg.nbytes())
+                return
+            except UnicodeDecodeError:
+                # 换下一个编码从头重读，并回滚本文件已累加的状态
+                agg.totals, agg.columns, agg.keys, agg.state = snapshot
+                if i == len(CSV_CONFIG['encodings']) - 1: raise
+
+    def _finish_sheet(self, sheet_name, df_clean):
+        # 异常检测在按对象汇总、Top10 截断之前跑，覆盖全部对象与日期
+        if sheet_name in ANOMALY_CONFIG['sheets']:
+            self.anomaly_dfs[sheet_name] = detect_anomalies(df_clean, sheet_name)
+
+        key_col = next((c for c in ["content_item", "dimension_item"] if c in df_clean.columns), None)
+        if key_col and parse_daily_dates(df_clean, 'date_range') is not None:
+            # 按天拆分的维度表：异常检测已按「对象 × 日期」打分，报告表格只需要对象汇总。
+            # Excel 路径下 clean_numeric 解析不了的单元格 (如「-」) 仍是字符串，汇总前先转成数值
+            df_items = df_clean.drop(columns='date_range')
+            for c in df_items.columns:
+                if c in ADDITIVE_METRICS: df_items[c] = clean_numeric_series(df_items[c])
+                elif c not in TEXT_COLS: df_items[c] = pd.to_numeric(df_items[c], errors='coerce')
+            items = StreamingSheetAggregator(sheet_name, keys=[key_col])
+            items.add(df_items)
+            df_clean = items.result()
+
+        if 'spend' in df_clean.columns:
+            self.active_counts[sheet_name] = int((_numeric_array(df_clean['spend']) > 0).sum())
+        if self.compare_frames is not None:
+            for section, sheet, section_key in COMPARE_SECTIONS:
+                if sheet == sheet_name and section_key in df_clean.columns:
+                    self.compare_frames[section] = _section_metrics(df_clean, section_key)
+        if sheet_name in TOPN_SHEETS:
+            if "spend" in df_clean.columns:
+                # 截断掉的长尾汇总成「其他」行
+                df_clean = compute_rankings(df_clean, RANKING_CONFIG['etl'], key_col)['top']
+
+        df_clean["Source_Sheet"] = sheet_name
+        if self.low_memory: df_clean = optimize_frame_memory(df_clean)
+        self.processed_dfs[sheet_name] = df_clean
+
+    def _merge_master_tables(self):
         for master_name, source_sheets in GROUP_CONFIG.items():
             dfs_to_merge = [self.processed_dfs[src] for src in source_sheets if src in self.processed_dfs]
             if dfs_to_merge:
+                self.budget.begin(self.held_nbytes())
                 merged_df = pd.concat(dfs_to_merge, ignore_index=True)
                 cols = list(merged_df.columns)
                 priority_cols = ['Source_Sheet', 'date_range', 'dimension_item', 'content_item',
                                  'spend', 'roas', 'purchases', 'cpa']
                 new_order = [c for c in priority_cols if c in cols] + [c for c in cols if c not in priority_cols]
                 self.merged_dfs[master_name] = merged_df[new_order]
+                if self.low_memory:
+                    self.merged_dfs[master_name] = optimize_frame_memory(self.merged_dfs[master_name])
+                    for src in source_sheets: self.processed_dfs.pop(src, None)
+                self.budget.check(f"合并 {master_name}", held=self.held_nbytes())
+        if self.low_memory: self.raw_file = None
+
+    def export_excel_bytes(self):
+        cells = sum(df.size for df in self.merged_dfs.values())
+        # 导出可能在 ETL 之后很久才触发，预算起点按本次导出重新记录
+        self.budget.begin(self.held_nbytes())
+        self.budget.check("导出 Excel", expected=cells * MEMORY_CONFIG['export_bytes_per_cell'], held=self.held_nbytes())
+        output_xls = io.BytesIO()
+        with pd.ExcelWriter(output_xls, engine='xlsxwriter') as writer:
+            for name, df in self.merged_dfs.items():
+                df.to_excel(writer, sheet_name=name, index=False)
+        data = output_xls.getvalue()
+        self.budget.check("导出 Excel", held=self.held_nbytes() + len(data))
+        return data
+
+    def _word_heading(self, text, level=1):
+        self.word_blocks.append(("heading", text, level))
+
+    def _word_table(self, df, title, level=1):
+        self.word_blocks.append(("table", df, title, level))
+
+    def build_docx(self):
+        cells = sum((b[1].shape[0] + 1) * b[1].shape[1] for b in self.word_blocks if b[0] == "table")
+        self.budget.begin(self.held_nbytes())
+        self.budget.check("生成 Word", expected=cells * MEMORY_CONFIG['docx_bytes_per_cell'], held=self.held_nbytes())
+        doc = Document()
+        for block in self.word_blocks:
+            if block[0] == "heading":
+                _, text, level = block
+                heading = doc.add_heading(text, level)
+                if level == 0: heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            else:
+                _, df, title, level = block
+                add_df_to_word(doc, df, title, level=level)
+        self.doc = doc
+        return doc
+
+    def export_docx_bytes(self):
+        if self.doc is None: self.build_docx()
+        else: self.budget.begin(self.held_nbytes())
+        output_doc = io.BytesIO()
+        self.doc.save(output_doc)
+        data = output_doc.getvalue()
+        self.budget.check("导出 Word", held=self.held_nbytes() + len(data))
+        # 字节已交给调用方，Document 对象不再常驻
+        self.doc = None
+        return data
 
     def generate_report(self):
-        benchmark_targets = {'roas': [2.0, True], 'cpm': [20.0, False], 'ctr': [0.015, True], 'cpc': [1.5, False], 'cpa': [30.0, False]}
-        if self.bench_file:
-            try:
-                df_b = pd.read_excel(self.bench_file)
-                benchmark_targets = extract_benchmark_values(df_b)
-            except: pass
+        benchmark_targets = resolve_benchmark_targets(self.bench_file, self.bench_key)
 
-        self.doc.add_heading('广告投放深度分析报告', 0).alignment = WD_ALIGN_PARAGRAPH.CENTER
+        self.word_blocks = [("heading", '广告投放深度分析报告', 0)]
         self.final_json = {"report_title": "广告投放深度分析报告", "generated_at": pd.Timestamp.now().strftime("%Y-%m-%d")}
 
         # 1. 大盘总览
@@ -437,7 +1516,7 @@ class AdReportProcessor:
 
                     df_f = pd.DataFrame(final_data, columns=col_order)
                     df_f_display = apply_report_labels(df_f)
-                    add_df_to_word(self.doc, df_f_display, "1. 数据大盘总览", level=1)
+                    self._word_table(df_f_display, "1. 数据大盘总览", level=1)
                     self.final_json['1_data_overview'] = df_f_display.to_dict(orient='records')
 
                     # 2. Benchmark
@@ -458,12 +1537,12 @@ class AdReportProcessor:
                             "对比结论": conclusion
                         })
                     df_b = pd.DataFrame(bench_data)
-                    add_df_to_word(self.doc, df_b, "2. 行业 Benchmark 对比", level=1)
+                    self._word_table(df_b, "2. 行业 Benchmark 对比", level=1)
                     self.final_json['2_industry_benchmark'] = df_b.to_dict(orient='records')
                 except Exception as e: st.warning(f"大盘计算警告: {e}")
 
         # 3. 受众组
-        self.doc.add_heading("3. 受众组分析", level=1)
+        self._word_heading("3. 受众组分析", level=1)
         self.final_json['3_audience_analysis'] = {}
         audience_configs = [
             ("3.1 国家分析", ["国家", "Country"], True, "国家"),
@@ -483,6 +1562,11 @@ class AdReportProcessor:
                     if not find_column_fuzzy(df_curr, ['ctr']): df_curr['ctr'] = df_curr['clicks'] / df_curr['impressions'].replace(0, np.nan) if 'impressions' in df_curr else 0
                     if not find_column_fuzzy(df_curr, ['cpa']): df_curr['cpa'] = df_curr['spend'] / df_curr['purchases'].replace(0, np.nan) if 'purchases' in df_curr else 0
 
+                    if "dimension_item" in df_curr.columns:
+                        df_curr = df_curr[~df_curr['dimension_item'].astype(str).str.lower().str.contains('unknow', na=False)]
+                    if top10 and 'spend' in df_curr.columns:
+                        df_curr = compute_rankings(df_curr, RANKING_CONFIG['audience'], 'dimension_item')['top']
+
                     req_cols = ["dimension_item", "spend", "ctr", "cpc", "cpm", "cpa", "roas"]
                     if "受众" in title: req_cols += ["converting_countries", "converting_keywords", "converting_genders", "converting_ages"]
 
@@ -501,14 +1585,12 @@ class AdReportProcessor:
                     for t_col in text_columns_to_fix:
                         if t_col in df_final.columns:
                             df_final[t_col] = df_final[t_col].fillna("-").astype(str).replace("nan", "-")
-                            
-                    if "dimension_item" in df_final.columns:
-                         df_final = df_final[~df_final['dimension_item'].astype(str).str.lower().str.contains('unknow', na=False)]
 
-                    if top10 and 'spend' in df_final.columns: df_final = df_final.sort_values('spend', ascending=False).head(10)
                     df_clean = df_final.round(2)
+                    if "受众" in title:
+                        df_clean = df_clean.join(format_confidence(rank_confidence(df_curr, self.sheet_totals)))
                     df_display = apply_report_labels(df_clean, custom_mapping={'dimension_item': dim_label})
-                    add_df_to_word(self.doc, df_display, title, level=2)
+                    self._word_table(df_display, title, level=2)
                     self.final_json['3_audience_analysis'][title] = df_display.to_dict(orient='records')
 
         # 4. 素材与落地页
@@ -523,6 +1605,8 @@ class AdReportProcessor:
                     if not find_column_fuzzy(df_curr, ['ctr']):
                          if 'impressions' in df_curr and 'clicks' in df_curr: df_curr['ctr'] = df_curr['clicks'] / df_curr['impressions'].replace(0, np.nan)
                          else: df_curr['ctr'] = np.nan
+                    if 'spend' in df_curr.columns:
+                        df_curr = compute_rankings(df_curr, RANKING_CONFIG['content'], 'content_item')['top']
                     if 'cpc' in df_curr.columns and 'cpm' in df_curr.columns:
                         mask_fix = (df_curr['ctr'].isna() | (df_curr['ctr'] == 0)) & (df_curr['cpc'] > 0)
                         if mask_fix.any(): df_curr.loc[mask_fix, 'ctr'] = df_curr.loc[mask_fix, 'cpm'] / (df_curr.loc[mask_fix, 'cpc'] * 1000)
@@ -535,17 +1619,16 @@ class AdReportProcessor:
                         found = find_column_fuzzy(df_curr, aliases)
                         if found: valid_cols.append(found); rename_map[found] = req
                         else: df_curr[req] = 0.0; valid_cols.append(req)
-                    df_final = df_curr[valid_cols].rename(columns=rename_map)
-                    if 'spend' in df_final.columns: df_final = df_final.sort_values('spend', ascending=False).head(10)
-                    df_clean = df_final.round(2) 
+                    df_clean = df_curr[valid_cols].rename(columns=rename_map).round(2)
+                    df_clean = df_clean.join(format_confidence(rank_confidence(df_curr, self.sheet_totals)))
                     
                     df_display = apply_report_labels(df_clean, custom_mapping={'content_item': label})
-                    add_df_to_word(self.doc, df_display, title, level=1)
+                    self._word_table(df_display, title, level=1)
                     self.final_json[json_key] = df_display.to_dict(orient='records')
                     
         # 5. 版位
         if "Master_Breakdown" in self.merged_dfs:
-             self.doc.add_heading("5. 版位分析", level=1)
+             self._word_heading("5. 版位分析", level=1)
              df_bd = self.merged_dfs["Master_Breakdown"]
              mask = df_bd['Source_Sheet'].astype(str).apply(lambda x: any(k in x for k in ["版位", "Placement"]))
              df_curr = df_bd[mask].copy()
@@ -554,23 +1637,21 @@ class AdReportProcessor:
                  if not find_column_fuzzy(df_curr, ['cpa']): df_curr['cpa'] = df_curr['spend'] / df_curr['purchases'].replace(0, np.nan) if 'purchases' in df_curr else 0
                  if not find_column_fuzzy(df_curr, ['ctr']): df_curr['ctr'] = df_curr['clicks'] / df_curr['impressions'].replace(0, np.nan) if 'impressions' in df_curr else 0
                  if not find_column_fuzzy(df_curr, ['cpm']): df_curr['cpm'] = (df_curr['spend'] / df_curr['impressions'].replace(0, np.nan)) * 1000 if 'impressions' in df_curr else 0
+                 # 花费 Top5 (含「其他」) 与高潜力 (CTR 高于均值且 CPM 低于均值) 在同一次调用里算出
+                 ranked = compute_rankings(df_curr, RANKING_CONFIG['placement'], 'dimension_item')
                  req_cols = ['dimension_item', 'spend', 'ctr', 'cpc', 'cpm', 'roas', 'cpa']
                  rename_map = {}; valid_cols = []
                  for c in req_cols:
                      aliases = FIELD_ALIASES.get(c, [c])
                      f = find_column_fuzzy(df_curr, aliases)
                      if f: valid_cols.append(f); rename_map[f] = c
-                     else: df_curr[c] = 0.0; valid_cols.append(c)
-                 df_clean = df_curr[valid_cols].rename(columns=rename_map).round(2)
-                 
-                 df_top5 = df_clean.sort_values('spend', ascending=False).head(5)
-                 add_df_to_word(self.doc, apply_report_labels(df_top5, {'dimension_item': '版位'}), "5.1 版位花费 TOP 5", level=2)
-                 
-                 mean_ctr = df_clean['ctr'].mean(); mean_cpm = df_clean['cpm'].mean()
-                 mask_pot = (df_clean['ctr'] > mean_ctr) & (df_clean['cpm'] < mean_cpm)
-                 df_pot = df_clean[mask_pot].sort_values('ctr', ascending=False).head(5)
-                 if df_pot.empty: df_pot = df_clean.sort_values('ctr', ascending=False).head(5)
-                 add_df_to_word(self.doc, apply_report_labels(df_pot, {'dimension_item': '版位'}), "5.2 版位高潜力", level=2)
+                     else: valid_cols.append(c)
+                 pick = lambda d: d.reindex(columns=valid_cols, fill_value=0.0).rename(columns=rename_map).round(2)
+                 df_top5 = pick(ranked['top_spend'])
+                 self._word_table(apply_report_labels(df_top5, {'dimension_item': '版位'}), "5.1 版位花费 TOP 5", level=2)
+
+                 df_pot = pick(ranked['high_potential'])
+                 self._word_table(apply_report_labels(df_pot, {'dimension_item': '版位'}), "5.2 版位高潜力", level=2)
                  
                  self.final_json['5_placement_analysis'] = {
                      "top_spend": apply_report_labels(df_top5, {'dimension_item': '版位'}).to_dict('records'),
@@ -595,24 +1676,121 @@ class AdReportProcessor:
             df_bd = self.merged_dfs["Master_Breakdown"]
             mask = df_bd['Source_Sheet'].astype(str).apply(lambda x: any(k in x for k in ["受众", "Audience"]))
             df_aud = df_bd[mask]
-            s_col = find_column_fuzzy(df_aud, ['spend']); active_count = len(df_aud[df_aud[s_col] > 0]) if s_col else 0
+            active_count = sum(n for s, n in self.active_counts.items() if any(k in s for k in ["受众", "Audience"]))
             top_share = "0%"
-            if not df_aud.empty and s_col:
-                total_s = df_aud[s_col].sum()
-                if total_s > 0: top_share = f"{df_aud[s_col].max()/total_s:.1%}"
+            if not df_aud.empty and 'spend' in df_aud.columns:
+                # 分母含「其他」行的花费，即全部受众的总花费
+                top1 = compute_rankings(df_aud, RANKING_CONFIG['structure'], 'dimension_item')['top1']
+                if not top1.empty and top1['spend_share'].iloc[0] > 0: top_share = f"{top1['spend_share'].iloc[0]:.1%}"
             rows.append({"模块": "受众结构", "当前结构数据表现": f"活跃受众组数: {active_count}\nTop1 花费占比: {top_share}", "存在的问题": ""})
         if "Master_Creative" in self.merged_dfs:
-             df_cr = self.merged_dfs["Master_Creative"]
-             mask = df_cr['Source_Sheet'].astype(str).apply(lambda x: any(k in x for k in ["素材", "Creative"]))
-             df_mat = df_cr[mask]
-             s_col = find_column_fuzzy(df_mat, ['spend']); active_count = len(df_mat[df_mat[s_col] > 0]) if s_col else 0
+             active_count = sum(n for s, n in self.active_counts.items() if any(k in s for k in ["素材", "Creative"]))
              rows.append({"模块": "素材结构", "当前结构数据表现": f"活跃素材数: {active_count}", "存在的问题": ""})
 
         df_struct = pd.DataFrame(rows)
-        add_df_to_word(self.doc, df_struct, "7. 广告架构分析", level=1)
+        self._word_table(df_struct, "7. 广告架构分析", level=1)
         if "Master_Overview" in self.merged_dfs:
              self.final_json['7_structure_analysis'] = df_struct.to_dict(orient='records')
 
+        # 8. 异常检测
+        anomaly_frames = [d for d in self.anomaly_dfs.values() if not d.empty]
+        if anomaly_frames:
+            df_anom = pd.concat(anomaly_frames, ignore_index=True)
+            df_top = summarize_anomalies(df_anom)
+            df_anom_display = format_anomalies(df_top.head(ANOMALY_CONFIG['max_json_rows']))
+            self._word_table(df_anom_display.head(ANOMALY_CONFIG['max_report_rows']), "8. 异常检测", level=1)
+            self.final_json['8_anomaly_detection'] = {
+                "total_flagged": int(len(df_anom)),
+                "flagged_items": int(df_top[['Source_Sheet', 'item']].drop_duplicates().shape[0]),
+                "items": df_anom_display.to_dict(orient='records')
+            }
+
+# ==========================================
+# PART 3.1: 多期对比
+# ==========================================
+
+@st.cache_resource
+def get_etl_cache():
+    return ContentCache(max_entries=COMPARE_CONFIG['cache_entries'])
+
+def run_etl_cached(file_obj, memory_limit_mb=None):
+    """同一份文件 (按内容哈希) 只做一次 ETL；多期对比时新增一期只需解析新文件。
+    缓存里只放 compare_periods 要用的各版块指标 {版块: DataFrame}，处理器与原始上传不保留"""
+    name = source_name(file_obj)
+    def build(data):
+        buf = io.BytesIO(data)
+        buf.name = name
+        processor = AdReportProcessor(buf, memory_limit_mb=memory_limit_mb)
+        processor.compare_frames = {}
+        processor.process_etl()
+        return processor.compare_frames
+    return get_etl_cache().get_or_build(read_upload_bytes(file_obj), build,
+                                        salt=f"{os.path.splitext(name)[1].lower()}|{memory_limit_mb or 0}")
+
+def _section_metrics(df, key_col):
+    """按对齐键汇总全部对象 (Top N 截断之前)：可加总列 groupby 求和，比率用汇总后的分子 / 分母重算，
+    缺少分子分母时退回按花费加权平均；排名在全部对象中计算"""
+    df = df[~rollup_mask(df[key_col])]
+    num = lambda c: pd.Series(np.nan_to_num(_numeric_array(df[c])), index=df.index)
+    frame = pd.DataFrame({c: num(c) for c in ADDITIVE_METRICS if c in df.columns}, index=df.index)
+    w = frame['spend'] if 'spend' in frame.columns else pd.Series(1.0, index=df.index)
+    for m in COMPARE_METRICS:
+        if m in frame.columns or m not in df.columns: continue
+        vals = pd.Series(_numeric_array(df[m]), index=df.index)
+        frame[f"__vw_{m}"] = (vals * w).where(vals.notna(), 0.0)
+        frame[f"__w_{m}"] = w.where(vals.notna(), 0.0)
+    g = frame.groupby(df[key_col].astype(str).to_numpy(), sort=False).sum()
+    out = pd.DataFrame(index=g.index.rename(key_col))
+    for m in COMPARE_METRICS:
+        if m in g.columns:
+            out[m] = g[m]
+            continue
+        value = pd.Series(np.nan, index=g.index)
+        if f"__w_{m}" in g.columns:
+            value = g[f"__vw_{m}"] / g[f"__w_{m}"].where(g[f"__w_{m}"] > 0)
+        if m in ROLLUP_RATIOS:
+            n_col, d_col, mult = ROLLUP_RATIOS[m]
+            if n_col in g.columns and d_col in g.columns:
+                value = (g[n_col] / g[d_col].where(g[d_col] > 0) * mult).fillna(value)
+        out[m] = value
+    out['rank'] = out['spend'].rank(ascending=False, method='min')
+    return out
+
+def compare_periods(periods):
+    """periods: [(标签, run_etl_cached 返回的 {版块: 指标表})]，按时间先后排列。
+    每个版块按对齐键做外连接 (哈希对齐)，相邻两期的指标变化率与排名变化整体向量化计算。"""
+    labels = [label for label, _ in periods]
+    result = {"report_title": "多期对比分析", "generated_at": pd.Timestamp.now().strftime("%Y-%m-%d"), "periods": labels}
+    for section, _, key_col in COMPARE_SECTIONS:
+        frames = {label: sections[section] for label, sections in periods
+                  if section in sections and not sections[section].empty}
+        if len(frames) < 2: continue
+
+        present = [l for l in labels if l in frames]
+        wide = pd.concat(frames, axis=1, join='outer')
+        cube = {m: wide.xs(m, axis=1, level=1)[present].to_numpy(dtype=float) for m in COMPARE_METRICS + ['rank']}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prev = {m: cube[m][:, :-1] for m in COMPARE_METRICS}
+            deltas = {m: np.where(np.abs(prev[m]) > 0, (cube[m][:, 1:] - prev[m]) / np.abs(prev[m]), np.nan) for m in COMPARE_METRICS}
+        # 排名上升为正
+        rank_change = cube['rank'][:, :-1] - cube['rank'][:, 1:]
+
+        order = np.argsort(-np.nan_to_num(cube['spend'][:, -1], nan=-1.0), kind='stable')[:COMPARE_CONFIG['max_rows']]
+        item_label = {"content_item": "素材名称" if section == "素材" else "落地页 URL"}.get(key_col, section)
+        table = {item_label: wide.index.to_numpy()[order]}
+        fmt = lambda key, values, is_mom=False: ["-" if pd.isna(v) else format_cell(key, float(v), is_mom=is_mom) for v in values]
+        for j, label in enumerate(present):
+            for m in COMPARE_METRICS:
+                table[f"{REPORT_MAPPING.get(m, m)} · {label}"] = fmt(m, cube[m][order, j])
+            table[f"排名 · {label}"] = ["-" if pd.isna(v) else f"{v:.0f}" for v in cube['rank'][order, j]]
+        for j in range(len(present) - 1):
+            step = f"{present[j]} → {present[j + 1]}"
+            for m in COMPARE_METRICS:
+                table[f"{REPORT_MAPPING.get(m, m)} 变化 · {step}"] = fmt(m, deltas[m][order, j], is_mom=True)
+            table[f"排名变化 · {step}"] = ["-" if pd.isna(v) else f"{v:+.0f}" for v in rank_change[order, j]]
+        result[section] = pd.DataFrame(table).to_dict(orient='records')
+    return result
+
 # ==========================================
 # PART 4: Streamlit UI
 # ==========================================
@@ -769,17 +1947,29 @@ def main():
         with st.container(border=True):
             st.markdown('<div class="icon-container">📊</div>', unsafe_allow_html=True)
             st.markdown('<div class="card-header">1.上传【周期性复盘报告】</div>', unsafe_allow_html=True)
-            raw_file = st.file_uploader("", type=["xlsx", "xls"], key="raw_uploader", label_visibility="collapsed")
+            raw_file = st.file_uploader("", type=["xlsx", "xls", "csv", "tsv", "zip"], key="raw_uploader", label_visibility="collapsed")
 
     with col2:
         with st.container(border=True):
             st.markdown('<div class="icon-container">🎯</div>', unsafe_allow_html=True)
             st.markdown('<div class="card-header">2.上传【行业 Benchmark]】</div>', unsafe_allow_html=True)
             bench_file = st.file_uploader("", type=["xlsx", "xls"], key="bench_uploader", label_visibility="collapsed")
+            bench_key = None
+            library = get_benchmark_library()
+            if library.keys():
+                # 未上传时按 行业 × 国家 从内置 Benchmark 库中选取
+                k_c1, k_c2 = st.columns(2)
+                vertical = k_c1.selectbox("行业", library.verticals(), key="bench_vertical")
+                country = k_c2.selectbox("国家", library.countries(vertical), key="bench_country")
+                bench_key = (vertical, country)
 
     st.write("")
     st.write("")
 
+    with st.expander("⚙️ 高级设置", expanded=False):
+        memory_limit_mb = st.number_input("单任务内存上限 (MB，0 表示不限制)", min_value=0, value=int(MEMORY_LIMIT_MB), step=256,
+                                          help="设置后启用低内存模式：释放中间表、压缩数值与维度列，超出上限时直接报错而不是被系统强制终止。")
+
     b_c1, b_c2, b_c3 = st.columns([1, 1, 1])
     with b_c2:
         start_btn = st.button("开始生成数据表 ✦", use_container_width=True)
@@ -789,79 +1979,126 @@ def main():
             st.error("⚠️ 请至少上传 [数据报表] 才能继续！")
             return
 
-        processor = AdReportProcessor(raw_file, bench_file)
+        processor = AdReportProcessor(raw_file, bench_file, bench_key, memory_limit_mb=memory_limit_mb or None)
+        for k in ("processor", "xlsx_bytes", "docx_bytes"): st.session_state.pop(k, None)
 
         try:
             with st.spinner("阶段 1/2: 数据清洗、Top10截断、降维合并..."):
                 processor.process_etl()
                 st.toast("✅ 阶段 1 完成：Master Tables 已生成", icon="✅")
 
-            with st.expander("📄 点击查看处理后的数据预览 (Master Tables)", expanded=False):
-                tabs = st.tabs(list(processor.merged_dfs.keys()))
-                for i, (k, v) in enumerate(processor.merged_dfs.items()):
-                    with tabs[i]: 
-                        st.dataframe(v.head(20), use_container_width=True)
-
-            with st.spinner("阶段 2/2: 生成架构诊断、Word报告 & JSON..."):
+            with st.spinner("阶段 2/2: 生成架构诊断 & JSON..."):
                 processor.generate_report()
-                st.toast("✅ 阶段 2 完成：所有报告已准备就绪", icon="🎉")
-            
-            st.balloons() 
-            
-            st.markdown("### 📥 下载结果文件")
-            
-            with st.container(border=True):
-                st.markdown("""
-                    <div class="glass-info-box">
-                        <span style="font-size: 1.2rem; margin-right: 0.8rem;">💡</span>
-                        <span style="
-                            font-weight: 600;
-                            background: linear-gradient(135deg, #662D8C 0%, #ED1E79 100%);
-                            -webkit-background-clip: text;
-                            -webkit-text-fill-color: transparent;
-                            font-family: -apple-system, BlinkMacSystemFont, sans-serif;
-                        ">
-                            建议：您可只选择下载 JSON 格式文件用于大模型分析，如有必要再下载其他格式文件。
-                        </span>
-                    </div>
-                """, unsafe_allow_html=True)
-
-                res_c1, res_c2, res_c3 = st.columns(3)
-
-                json_str = json.dumps(processor.final_json, indent=4, ensure_ascii=False)
-                res_c1.download_button(
-                    "📥 JSON (大模型分析)", 
-                    json_str, 
-                    "Ad_Report_Data.json", 
-                    "application/json",
-                    use_container_width=True
-                )
+                st.toast("✅ 阶段 2 完成：报告预览已就绪", icon="🎉")
+
+            # 结果存入会话，点击「生成 Word」等按钮触发重跑时无需重新计算；只留预览与导出用得到的部分
+            processor.release_sources()
+            st.session_state["processor"] = processor
+            st.balloons()
+        except MemoryBudgetExceeded as e:
+            st.error(f"❌ {e}")
+            return
+        except Exception as e:
+            st.error(f"❌ 处理过程中发生错误: {str(e)}")
+            st.exception(e)
+            return
+
+    with st.expander("📈 多期对比 (上传两个及以上周期的复盘报告)", expanded=False):
+        period_files = st.file_uploader("按时间先后依次上传", type=["xlsx", "xls", "csv", "tsv", "zip"],
+                                        accept_multiple_files=True, key="period_uploader")
+        if st.button("开始对比 ✦", use_container_width=True, key="compare_btn"):
+            if not period_files or len(period_files) < 2:
+                st.error("⚠️ 请至少上传两个周期的文件！")
+            else:
+                try:
+                    with st.spinner("正在解析并对齐各周期数据..."):
+                        periods = [(f"P{i + 1} {os.path.splitext(f.name)[0]}", run_etl_cached(f, memory_limit_mb or None))
+                                   for i, f in enumerate(period_files)]
+                        compare_json = compare_periods(periods)
+                    components.html(render_html_report(compare_json), height=700, scrolling=True)
+                    st.download_button("📥 对比 JSON", json.dumps(compare_json, indent=4, ensure_ascii=False),
+                                       "Ad_Report_Compare.json", "application/json", use_container_width=True)
+                except MemoryBudgetExceeded as e:
+                    st.error(f"❌ {e}")
+                except Exception as e:
+                    st.error(f"❌ 对比过程中发生错误: {str(e)}")
+                    st.exception(e)
+
+    processor = st.session_state.get("processor")
+    if processor is None: return
+
+    try:
+        with st.expander("📄 点击查看处理后的数据预览 (Master Tables)", expanded=False):
+            tabs = st.tabs(list(processor.merged_dfs.keys()))
+            for i, (k, v) in enumerate(processor.merged_dfs.items()):
+                with tabs[i]: 
+                    st.dataframe(v.head(20), use_container_width=True)
 
-                output_xls = io.BytesIO()
-                with pd.ExcelWriter(output_xls, engine='xlsxwriter') as writer:
-                    for name, df in processor.merged_dfs.items(): 
-                        df.to_excel(writer, sheet_name=name, index=False)
+        st.markdown("### 📊 报告预览")
+        with st.container(border=True):
+            components.html(render_html_report(processor.final_json), height=900, scrolling=True)
+
+        st.markdown("### 📥 下载结果文件")
+        
+        with st.container(border=True):
+            st.markdown("""
+                <div class="glass-info-box">
+                    <span style="font-size: 1.2rem; margin-right: 0.8rem;">💡</span>
+                    <span style="
+                        font-weight: 600;
+                        background: linear-gradient(135deg, #662D8C 0%, #ED1E79 100%);
+                        -webkit-background-clip: text;
+                        -webkit-text-fill-color: transparent;
+                        font-family: -apple-system, BlinkMacSystemFont, sans-serif;
+                    ">
+                        建议：您可只选择下载 JSON 格式文件用于大模型分析，如有必要再下载其他格式文件。
+                    </span>
+                </div>
+            """, unsafe_allow_html=True)
+
+            res_c1, res_c2, res_c3 = st.columns(3)
+
+            json_str = json.dumps(processor.final_json, indent=4, ensure_ascii=False)
+            res_c1.download_button(
+                "📥 JSON (大模型分析)", 
+                json_str, 
+                "Ad_Report_Data.json", 
+                "application/json",
+                use_container_width=True
+            )
+
+            # Excel / Word 都只在用户需要时才生成
+            if "xlsx_bytes" not in st.session_state:
+                if res_c2.button("📊 生成 Excel", use_container_width=True):
+                    with st.spinner("正在生成 Excel..."):
+                        st.session_state["xlsx_bytes"] = processor.export_excel_bytes()
+            if "xlsx_bytes" in st.session_state:
                 res_c2.download_button(
                     "📥 Excel (数据透视)", 
-                    output_xls.getvalue(), 
+                    st.session_state["xlsx_bytes"], 
                     "Merged_Ad_Report_Final.xlsx", 
                     "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     use_container_width=True
                 )
 
-                output_doc = io.BytesIO()
-                processor.doc.save(output_doc)
+            if "docx_bytes" not in st.session_state:
+                if res_c3.button("📝 生成 Word 报告", use_container_width=True):
+                    with st.spinner("正在生成 Word 报告..."):
+                        st.session_state["docx_bytes"] = processor.export_docx_bytes()
+            if "docx_bytes" in st.session_state:
                 res_c3.download_button(
                     "📥 Word (数据审查)", 
-                    output_doc.getvalue(), 
+                    st.session_state["docx_bytes"], 
                     "Ad_Report_Final_V20_10.docx", 
                     "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                     use_container_width=True
                 )
 
-        except Exception as e:
-            st.error(f"❌ 处理过程中发生错误: {str(e)}")
-            st.exception(e)
+    except MemoryBudgetExceeded as e:
+        st.error(f"❌ {e}")
+    except Exception as e:
+        st.error(f"❌ 处理过程中发生错误: {str(e)}")
+        st.exception(e)
 
 if __name__ == "__main__":
     main()
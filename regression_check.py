@@ -0,0 +1,340 @@
+"""
+报告流水线回归校验：golden 输出比对 + 各阶段耗时/内存预算。
+
+用法：
+    python regression_check.py                 # 与 golden/ 下的基准逐项比对，并检查性能预算
+    python regression_check.py --update        # 以当前代码的输出重新生成 golden (确认数值变化符合预期后再执行)
+    python regression_check.py --only alias_variants percent_strings
+    python regression_check.py --budget-scale 2  # 机器较慢时放宽预算
+
+fixture 工作簿由本脚本按固定规则生成 (不依赖随机数)，覆盖标准列名、别名列名、缺失 Sheet、
+百分比/货币字符串、CSV zip 流式路径、按天拆分的维度表 (对象 × 日期)、含「-」单元格与整段时间范围的原样导出，
+较大的数据集，以及设置了内存上限的低内存模式。
+比对内容：final_json (generated_at 除外)、Master Excel 各 Sheet 的单元格、DOCX 各表格的文本，要求完全一致；
+按天拆分的 fixture 另外断言人为制造的花费异常出现在异常检测表的前 max_report_rows 行。
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import numpy as np
+import pandas as pd
+from docx import Document
+from openpyxl import load_workbook
+
+import app
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+# 各阶段预算：秒 / MB (tracemalloc 峰值)，约为本机实测值的 2~3 倍 (docx 耗时波动大，按多次实测的最大值)，
+# 能拦住数倍级的性能退化；机器较慢时用 --budget-scale 整体放宽。较大的数据集单独给 ETL 预算
+_SMALL_BUDGETS = {
+    "etl": (1.2, 3), "report": (0.5, 1.5), "excel": (0.25, 1.5), "docx": (8.0, 6), "html": (0.005, 0.25),
+}
+STAGE_BUDGETS = {
+    "default": _SMALL_BUDGETS,
+    "daily_breakdown": {**_SMALL_BUDGETS, "etl": (1.5, 6)},
+    "large": {**_SMALL_BUDGETS, "etl": (3.0, 14), "report": (0.6, 2), "html": (0.006, 0.8)},
+    "daily_large": {**_SMALL_BUDGETS, "etl": (3.0, 96)},
+}
+
+
+# ==========================================
+# Fixture 工作簿
+# ==========================================
+
+def _daily(days, spend_col="花费金额(USD)", pct_strings=False):
+    dates = pd.date_range("2024-03-01", periods=days)
+    i = pd.Series(range(days))
+    df = pd.DataFrame({
+        "时间范围": dates.strftime("%Y-%m-%d"),
+        spend_col: 120 + (i * 37 % 50) + 0.25 * (i % 4),
+        "购买次数": 3 + i * 7 % 11,
+        "购买价值": 300 + (i * 53 % 200) + 0.5 * (i % 2),
+        "链接点击": 200 + i * 29 % 150,
+        "展示次数": 9000 + i * 311 % 4000,
+        "落地页浏览量": 150 + i * 17 % 100,
+        "加入购物车": 20 + i * 5 % 15,
+        "结账发起次数": 10 + i * 3 % 8,
+    })
+    df.loc[days * 2 // 3, spend_col] = 900  # 人为制造一个花费异常日
+    if pct_strings:
+        df[spend_col] = df[spend_col].map(lambda v: f"${v:,.2f}")
+        df["购买价值"] = df["购买价值"].map(lambda v: f"¥{v:,.2f}")
+        df["链接点击率"] = (df["链接点击"] / df["展示次数"]).map(lambda v: f"{v * 100:.2f}%")
+    return df
+
+def _items(names, key_col, spend_col="花费金额(USD)", pct_strings=False):
+    n = len(names)
+    i = pd.Series(range(n))
+    df = pd.DataFrame({
+        key_col: names,
+        spend_col: 40 + (i * 71 % 460) + 0.01 * (i % 7),
+        "购买次数": i * 13 % 29,
+        "购买价值": (i * 97 % 900) + 0.5,
+        "链接点击": 30 + i * 43 % 470,
+        "展示次数": 2000 + i * 733 % 18000,
+        "千次展示费用": 5 + i % 20,
+    })
+    if pct_strings:
+        df[spend_col] = df[spend_col].map(lambda v: f"${v:,.2f}")
+        df["链接点击率"] = (df["链接点击"] / df["展示次数"]).map(lambda v: f"{v * 100:.2f}%")
+    return df
+
+def _items_daily(names, key_col, days, spend_col="花费金额(USD)"):
+    """对象 × 日期的长表 (广告后台按天拆分导出)；第 2/3 处的那天给第 4 个对象人为制造一次花费异常"""
+    n, dates = len(names), pd.date_range("2024-03-01", periods=days).strftime("%Y-%m-%d")
+    k = pd.Series(range(n)).repeat(days).reset_index(drop=True)
+    d = pd.Series(list(range(days)) * n)
+    df = pd.DataFrame({
+        "时间范围": list(dates) * n,
+        key_col: pd.Series(names).repeat(days).to_numpy(),
+        spend_col: 5 + (k * 71 % 46) + (k * 7 + d * 13) % 9 + 0.01 * (d % 7),
+        "购买次数": (k * 13 + d * 5) % 4,
+        "购买价值": (k * 97 + d * 31) % 90 + 0.5,
+        "链接点击": 10 + (k * 43 + d * 11) % 40,
+        "展示次数": 800 + (k * 733 + d * 97) % 1500,
+    })
+    df.loc[(k == 3) & (d == days * 2 // 3), spend_col] *= 8
+    return df
+
+def _daily_workbook(days=30, n_creatives=40):
+    creatives = [f"https://shop.example.com/ad/{k}" for k in range(n_creatives)]
+    return {
+        "分时段数据": _daily(days),
+        "素材": _items_daily(creatives, "素材", days),
+        "受众组": _items_daily([f"AS-{k:03d}" for k in range(25)], "广告组", days),
+        "国家": _items_daily(["US", "CA", "GB", "DE", "FR", "AU", "JP"], "国家/地区", days),
+        "平台&版位": _items_daily(["fb feed", "ig feed", "ig stories", "reels", "audience network", "messenger"], "平台&版位", days),
+    }
+
+def _workbook(days=30, n_creatives=40, spend_col="花费金额(USD)", pct_strings=False, aliases=False, sheets=None):
+    creatives = [f"https://shop.example.com/ad/{k}" for k in range(n_creatives)]
+    countries = ["US", "CA", "GB", "DE", "FR", "AU", "JP", "unknown"]
+    book = {
+        "整体数据": _daily(days, spend_col, pct_strings).head(1),
+        "分时段数据": _daily(days, spend_col, pct_strings),
+        "素材": _items(creatives, "素材", spend_col, pct_strings),
+        "落地页": _items(creatives[:15], "落地页" if aliases else "落地页url", spend_col, pct_strings),
+        "受众组": _items([f"AS-{k:03d}" for k in range(25)], "Ad Set Name" if aliases else "广告组", spend_col, pct_strings),
+        "国家": _items(countries, "国家" if aliases else "国家/地区", spend_col, pct_strings),
+        "年龄": _items(["18-24", "25-34", "35-44", "45-54", "55-64", "65+"], "年龄", spend_col, pct_strings),
+        "性别": _items(["male", "female", "unknown"], "性别", spend_col, pct_strings),
+        "平台&版位": _items(["fb feed", "ig feed", "ig stories", "reels", "audience network", "messenger"], "平台&版位", spend_col, pct_strings),
+    }
+    if aliases:
+        book = {k: v.rename(columns={"购买次数": "成效", "购买价值": "Purchase Value", "展示次数": "Impressions"}) for k, v in book.items()}
+    if sheets: book = {k: v for k, v in book.items() if k in sheets}
+    return book
+
+def _dash_cells(book, days=30):
+    """模拟广告后台的原样导出：没有购买时单次购买费用记「-」，按天的表偶尔也有「-」；
+    不按天拆分的维度表带一列整段时间范围"""
+    period = f"2024-03-01 - {(pd.Timestamp('2024-03-01') + pd.Timedelta(days=days - 1)):%Y-%m-%d}"
+    out = {}
+    for name, df in book.items():
+        df = df.copy()
+        if name not in ("整体数据", "分时段数据"):
+            spend = pd.to_numeric(df.filter(like="花费金额").iloc[:, 0])
+            df["单次购买费用"] = [round(s / p, 2) if p > 0 else "-" for s, p in zip(spend, df["购买次数"])]
+            if "时间范围" not in df.columns: df.insert(0, "时间范围", period)
+            else: df["购买价值"] = df["购买价值"].where(df.index % 17 != 5, "-")
+        out[name] = df
+    return out
+
+def _write_xlsx(book, path):
+    with pd.ExcelWriter(path, engine="xlsxwriter") as writer:
+        for name, df in book.items(): df.to_excel(writer, sheet_name=name, index=False)
+
+def _write_csv_zip(book, path):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, df in book.items(): zf.writestr(f"export/{name}.csv", df.to_csv(index=False).encode("utf-8-sig"))
+
+FIXTURES = {
+    "standard": ("xlsx", lambda: _workbook()),
+    "alias_variants": ("xlsx", lambda: _workbook(spend_col="花费金额 (USD)", aliases=True)),
+    "missing_sheets": ("xlsx", lambda: _workbook(sheets=["分时段数据", "素材", "国家"])),
+    "percent_strings": ("xlsx", lambda: _workbook(pct_strings=True)),
+    "csv_zip": ("zip", lambda: _workbook()),
+    "large": ("xlsx", lambda: _workbook(days=90, n_creatives=5000)),
+    "daily_breakdown": ("xlsx", lambda: _daily_workbook()),
+    "daily_large": ("zip", lambda: _daily_workbook(days=90, n_creatives=2000)),
+    "dash_cells": ("xlsx", lambda: _dash_cells({**_workbook(), "国家": _items_daily(["US", "CA", "GB", "DE", "FR", "AU", "JP"], "国家/地区", 30)})),
+    # 第三项为 AdReportProcessor 的额外参数：设置内存上限即走低内存模式 (降精度、合并后释放单表、丢弃原始文件)
+    "low_memory": ("zip", lambda: _daily_workbook(), {"memory_limit_mb": 256}),
+}
+
+def _spike_flags(days):
+    """_daily / _items_daily 人为制造的花费异常：(来源 Sheet, 对象, 日期)，必须出现在 Word 异常表 (前 max_report_rows 行) 里"""
+    date = (pd.Timestamp("2024-03-01") + pd.Timedelta(days=days * 2 // 3)).strftime("%Y-%m-%d")
+    return [("分时段数据", "整体", date), ("素材", "https://shop.example.com/ad/3", date),
+            ("受众组", "AS-003", date), ("国家", "DE", date), ("平台&版位", "reels", date)]
+
+# 任务内存预算校验 (check_memory_budget)：任务上限、同进程另一个会话持有的内存、必然超限的上限，单位 MB
+MEMORY_BUDGET_CHECK = {"limit_mb": 64, "other_session_mb": 256, "tiny_limit_mb": 0.5}
+
+EXPECTED_ANOMALIES = {
+    "daily_breakdown": _spike_flags(30),
+    "daily_large": _spike_flags(90),
+    "low_memory": _spike_flags(30),
+}
+
+
+# ==========================================
+# 运行流水线并采集输出
+# ==========================================
+
+def _stage(stats, name, fn, measure_memory):
+    if measure_memory:
+        tracemalloc.start()
+        result = fn()
+        stats[name] = {"mb": tracemalloc.get_traced_memory()[1] / 2**20}
+        tracemalloc.stop()
+    else:
+        t0 = time.perf_counter()
+        result = fn()
+        stats[name] = {"seconds": time.perf_counter() - t0}
+    return result
+
+def run_pipeline(path, measure_memory=False, **options):
+    stats = {}
+    processor = app.AdReportProcessor(path, **options)
+    _stage(stats, "etl", processor.process_etl, measure_memory)
+    _stage(stats, "report", processor.generate_report, measure_memory)
+    excel_bytes = _stage(stats, "excel", processor.export_excel_bytes, measure_memory)
+    docx_bytes = _stage(stats, "docx", processor.export_docx_bytes, measure_memory)
+    _stage(stats, "html", lambda: app.render_html_report(processor.final_json), measure_memory)
+    return processor, excel_bytes, docx_bytes, stats
+
+def check_memory_budget(tmp):
+    """设置 memory_limit_mb 跑完整流水线：
+    - ETL 之后同一进程里另一个「会话」持有远超上限的内存，本任务后续阶段不应因此超限
+    - 上限远小于报告需要的内存时，应抛出 MemoryBudgetExceeded"""
+    cfg, failures = MEMORY_BUDGET_CHECK, []
+    path = os.path.join(tmp, "memory_budget.xlsx")
+    _write_xlsx(_workbook(), path)
+
+    job = app.AdReportProcessor(path, memory_limit_mb=cfg["limit_mb"])
+    try:
+        job.process_etl()
+        other_session = np.ones(cfg["other_session_mb"] * 2**20 // 8)
+        job.generate_report()
+        job.export_excel_bytes()
+        job.export_docx_bytes()
+        del other_session
+    except app.MemoryBudgetExceeded as e:
+        failures.append(f"memory_budget: 其他会话的内存被计入了本任务 -> {e}")
+
+    tiny = app.AdReportProcessor(path, memory_limit_mb=cfg["tiny_limit_mb"])
+    try:
+        tiny.process_etl()
+        tiny.generate_report()
+        tiny.export_excel_bytes()
+        tiny.export_docx_bytes()
+        failures.append(f"memory_budget: 上限 {cfg['tiny_limit_mb']} MB 时没有抛出 MemoryBudgetExceeded")
+    except app.MemoryBudgetExceeded:
+        pass
+    print(f"[memory_budget] 上限 {cfg['limit_mb']} MB，任务峰值约 {job.budget.peak_bytes / 2**20:.1f} MB")
+    return failures
+
+def snapshot(processor, excel_bytes, docx_bytes):
+    final_json = json.loads(json.dumps(processor.final_json, ensure_ascii=False, default=str))
+    final_json["generated_at"] = "<generated_at>"
+    wb = load_workbook(io.BytesIO(excel_bytes), read_only=True)
+    excel = {ws.title: [list(row) for row in ws.iter_rows(values_only=True)] for ws in wb.worksheets}
+    wb.close()
+    doc = Document(io.BytesIO(docx_bytes))
+    docx_tables = [[[cell.text for cell in row.cells] for row in table.rows] for table in doc.tables]
+    return json.loads(json.dumps({"final_json": final_json, "excel": excel, "docx_tables": docx_tables},
+                                 ensure_ascii=False, default=str))
+
+def missing_anomalies(final_json, expected):
+    rows = final_json.get("8_anomaly_detection", {}).get("items", [])[:app.ANOMALY_CONFIG['max_report_rows']]
+    found = {(r["来源"], r["对象"], r["日期"]) for r in rows if r["指标"] == app.REPORT_MAPPING["spend"]}
+    return [e for e in expected if e not in found]
+
+def first_difference(expected, actual, path="$"):
+    if type(expected) is not type(actual):
+        return f"{path}: 类型不同 {type(expected).__name__} != {type(actual).__name__}"
+    if isinstance(expected, dict):
+        for k in list(expected) + [k for k in actual if k not in expected]:
+            if k not in actual: return f"{path}.{k}: 缺失"
+            if k not in expected: return f"{path}.{k}: 多出"
+            diff = first_difference(expected[k], actual[k], f"{path}.{k}")
+            if diff: return diff
+        return None
+    if isinstance(expected, list):
+        if len(expected) != len(actual): return f"{path}: 长度 {len(expected)} != {len(actual)}"
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            diff = first_difference(e, a, f"{path}[{i}]")
+            if diff: return diff
+        return None
+    if isinstance(expected, float) and expected != expected and actual != actual: return None  # NaN == NaN
+    return None if expected == actual else f"{path}: {expected!r} != {actual!r}"
+
+
+# ==========================================
+# 主流程
+# ==========================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="报告流水线 golden 回归与性能预算校验")
+    parser.add_argument("--update", action="store_true", help="用当前输出覆盖 golden")
+    parser.add_argument("--only", nargs="*", help="只运行指定 fixture")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="性能预算放宽倍数")
+    parser.add_argument("--skip-budget", action="store_true", help="只比对输出，不检查性能预算")
+    args = parser.parse_args(argv)
+
+    names = args.only or list(FIXTURES)
+    failures = []
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            kind, build, *options = FIXTURES[name]
+            options = options[0] if options else {}
+            path = os.path.join(tmp, f"{name}.{kind}")
+            (_write_csv_zip if kind == "zip" else _write_xlsx)(build(), path)
+
+            processor, excel_bytes, docx_bytes, stats = run_pipeline(path, **options)
+            if not args.skip_budget:
+                for stage, mem in run_pipeline(path, measure_memory=True, **options)[3].items(): stats[stage].update(mem)
+            snap = snapshot(processor, excel_bytes, docx_bytes)
+            missing = missing_anomalies(snap["final_json"], EXPECTED_ANOMALIES.get(name, []))
+            if missing: failures.append(f"{name}: 人为制造的花费异常未出现在异常检测表中 -> {missing}")
+            golden_path = os.path.join(GOLDEN_DIR, f"{name}.json")
+
+            if args.update:
+                with open(golden_path, "w", encoding="utf-8") as f:
+                    json.dump(snap, f, ensure_ascii=False, indent=1)
+                print(f"[更新] {name}")
+            elif not os.path.exists(golden_path):
+                failures.append(f"{name}: 缺少 golden，请先运行 --update")
+            else:
+                with open(golden_path, encoding="utf-8") as f: expected = json.load(f)
+                diff = first_difference(expected, snap)
+                if diff: failures.append(f"{name}: 输出与 golden 不一致 -> {diff}")
+
+            if not args.skip_budget:
+                budgets = STAGE_BUDGETS.get(name, STAGE_BUDGETS["default"])
+                for stage, (max_s, max_mb) in budgets.items():
+                    s = stats[stage]
+                    if s["seconds"] > max_s * args.budget_scale:
+                        failures.append(f"{name}/{stage}: 耗时 {s['seconds']:.3f}s 超出预算 {max_s * args.budget_scale:.3f}s")
+                    if s["mb"] > max_mb * args.budget_scale:
+                        failures.append(f"{name}/{stage}: 内存峰值 {s['mb']:.2f}MB 超出预算 {max_mb * args.budget_scale:.2f}MB")
+                print(f"[{name}] " + "  ".join(f"{k}: {v['seconds']:.3f}s/{v['mb']:.2f}MB" for k, v in stats.items()))
+
+        if not args.only and not args.update: failures += check_memory_budget(tmp)
+
+    for f in failures: print(f"❌ {f}")
+    if not failures and not args.update: print("✅ 全部通过")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())